@@ -1,9 +1,20 @@
+from __future__ import annotations
+
+import argparse
+import functools
+import io
 import json
-import re
 import typing
 
-from word import Word, WordNotFound, WordQuiz, DefinitionNotFound
+from word import Word, WordNotFound, WordQuiz, DefinitionNotFound, parse_word_input, prewarm_dictionary
 from quiz import Quiz
+from sender import Sender
+from chat_dispatcher import ChatDispatcher
+from storage import storage
+from state_store import StateRecord, StateStore
+from wiktionary import wiktionary_client
+import wiki_cache
+import webhook
 import aiogram
 
 with open('data/token.txt', 'r') as file:
@@ -13,7 +24,10 @@ with open('data/telegram_whitelist.txt', 'r') as file:
     whitelist = list(map(int, file.read().split('\n')))
 
 bot = aiogram.Bot(token)
+sender = Sender(bot)
 buttons_in_a_row = 3
+# telegram's limit of a message's text
+message_max_length = 4096
 
 
 def get_keyboard(answers: typing.Iterable[str], add_back=True) -> aiogram.types.ReplyKeyboardMarkup:
@@ -48,20 +62,50 @@ def get_inline_keyboard(options: list[tuple[str, str]]):
 
 
 async def report_wrong_input(user_id):
-    await bot.send_message(user_id, 'Incorrect input, use keyboard buttons')
+    await sender.send_message(user_id, 'Incorrect input, use keyboard buttons')
 
 
 class State:
+    # state classes by their names, to restore states from their records
+    kinds: dict[str, type[State]] = {}
+
     def __init__(self, user_id):
         self.user_id = user_id
         self.quiz = Quiz(user_id)
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        State.kinds[cls.__name__] = cls
+
     async def enter(self):
         pass
 
     async def process_msg(self, message: str):
         return self
 
+    @property
+    def keyboard_message_id(self) -> int | None:
+        """
+        id of the message with the inline keyboard the state waits on, callbacks of other messages are stale
+        """
+        return None
+
+    def callback_data(self, message: str) -> str:
+        """
+        data of an inline button, the state is kept as a message can be edited into a keyboard of another state
+        """
+        return json.dumps({'message': message, 'state': type(self).__name__})
+
+    def to_record(self) -> StateRecord:
+        return StateRecord(type(self).__name__)
+
+    @classmethod
+    async def from_record(cls, user_id: int, record: StateRecord) -> State:
+        """
+        restores the state as it was after it was entered
+        """
+        return cls(user_id)
+
 
 class AskerState(State):
     """
@@ -75,7 +119,7 @@ class AskerState(State):
 
     async def enter(self):
         keyboard = get_keyboard(self.next_steps.keys(), add_back=False)
-        await bot.send_message(self.user_id, self.message, reply_markup=keyboard)
+        await sender.send_message(self.user_id, self.message, reply_markup=keyboard)
 
     async def process_msg(self, message: str) -> State:
         if message in self.next_steps:
@@ -91,6 +135,7 @@ class DefaultState(AskerState):
     """
 
     message = "Press add word button to add a new word to your quiz\n\n" \
+              "To add many words at once press import words button\n\n" \
               "To perform a recall press recall word button"
 
     next_steps = {}  # to be defined later
@@ -123,15 +168,22 @@ class ConfirmAddNewWordState(State):
         super().__init__(user_id)
         self.word = word
 
+    def to_record(self) -> StateRecord:
+        return StateRecord(type(self).__name__, self.word.word, self.word.part_of_speech)
+
+    @classmethod
+    async def from_record(cls, user_id: int, record: StateRecord) -> State:
+        return cls(user_id, await storage.get_word(record.word, record.part_of_speech))
+
     async def enter(self):
-        message = '\n'.join([self.word.__repr__()] + self.word.en_definitions + ['confirm adding this word?'])
+        message = '\n'.join([self.word.__repr__(), *self.word.en_definitions, 'confirm adding this word?'])
         answers = ['Yes', 'No']
-        await bot.send_message(self.user_id, message, reply_markup=get_keyboard(answers))
+        await sender.send_message(self.user_id, message, reply_markup=get_keyboard(answers))
 
     @basic_input_handler(commands=['Yes', 'No'])
     async def process_msg(self, message: str):
         if message == 'Yes':
-            self.quiz.add_new_word(self.word)
+            await storage.add_new_word(self.quiz, self.word)
             return InputNewWordState(self.user_id)
         elif message == 'No':
             return InputNewWordState(self.user_id)
@@ -143,6 +195,13 @@ class EnterWordDefinition(State):
         self.word = word
         self.part_of_speech = part_of_speech
 
+    def to_record(self) -> StateRecord:
+        return StateRecord(type(self).__name__, self.word, self.part_of_speech)
+
+    @classmethod
+    async def from_record(cls, user_id: int, record: StateRecord) -> State:
+        return cls(user_id, record.word, record.part_of_speech)
+
     async def enter(self):
         message = "Unable to find a definition in the dictionary\n" \
                   "Enter the translation manually\n" \
@@ -151,25 +210,22 @@ class EnterWordDefinition(State):
         if self.part_of_speech is None:
             message += ', specify a part of speech'
 
-        await bot.send_message(self.user_id, message)
+        await sender.send_message(self.user_id, message)
 
     @basic_input_handler()
     async def process_msg(self, message: str):
         if self.part_of_speech is None:
-            part_of_speech_ = re.findall('\[[^]]+]', message)
-
-            if part_of_speech_:
-                self.part_of_speech = part_of_speech_[0][1:-1]
-                message.word = re.sub(' \[[^]]+]', '', message)
+            message, self.part_of_speech = parse_word_input(message)
 
         try:
-            word_obj = Word(self.word, part_of_speech=self.part_of_speech, definitions=message.split('\n'))
+            word_obj = await storage.get_word(self.word, part_of_speech=self.part_of_speech,
+                                              definitions=message.split('\n'))
             return ConfirmAddNewWordState(self.user_id, word_obj)
         except WordNotFound:
             message = "Word was not found on wikictionary\n" \
                       "thus there most likely is a typo"
 
-            await bot.send_message(self.user_id, message)
+            await sender.send_message(self.user_id, message)
             return InputNewWordState(self.user_id)
 
 
@@ -178,21 +234,14 @@ class InputNewWordState(State):
         message = "Enter a word you want to add.\n" \
                   "To specify part of speech enclose is it in [] i.e. [adj]"
 
-        await bot.send_message(self.user_id, message, reply_markup=get_keyboard([]))
+        await sender.send_message(self.user_id, message, reply_markup=get_keyboard([]))
 
     @basic_input_handler()
     async def process_msg(self, message: str) -> State:
-        word = message
-        try:
-            part_of_speech = re.findall('\[[^]]+]', word)
-
-            if part_of_speech:
-                part_of_speech = part_of_speech[0][1:-1]
-                word = re.sub(' \[[^]]+]', '', word)
-            else:
-                part_of_speech = None
+        word, part_of_speech = parse_word_input(message)
 
-            word_obj = Word(word, part_of_speech)
+        try:
+            word_obj = await storage.get_word(word, part_of_speech)
         except DefinitionNotFound:
             """
             word was not found in the dictionary, but can maybe be found on the wiki
@@ -202,27 +251,46 @@ class InputNewWordState(State):
         except WordNotFound:
             message = "Word was not found on wikictionary\n" \
                       "thus there most likely is a typo"
-            await bot.send_message(self.user_id, message)
+            await sender.send_message(self.user_id, message)
             return self
 
-        if self.quiz.Table.check_user_has_word(self.user_id, word_obj):
+        if await storage.has_word(self.quiz, word_obj):
             message = "Word already in quiz"
-            await bot.send_message(self.user_id, message)
+            await sender.send_message(self.user_id, message)
             return self
 
         return ConfirmAddNewWordState(self.user_id, word_obj)
 
 
+class ImportWordsState(State):
+    async def enter(self):
+        message = "Send a list of words or a text file with a word per line.\n" \
+                  "To specify part of speech enclose is it in [] i.e. [adj]"
+
+        await sender.send_message(self.user_id, message, reply_markup=get_keyboard([]))
+
+    @basic_input_handler()
+    async def process_msg(self, message: str) -> State:
+        report = await storage.add_words(self.quiz, message.split('\n'))
+        await sender.send_message(self.user_id, report.format(message_max_length))
+        return DefaultState(self.user_id)
+
+
 class WordQuizShowAnsState(State):
     def __init__(self, user_id: int, word_quiz_state: State):
         super().__init__(user_id)
         self.word_quiz_state = word_quiz_state
 
+    @classmethod
+    async def from_record(cls, user_id: int, record: StateRecord) -> State:
+        # progress of the word quiz is not stored, the conversation starts over
+        return DefaultState(user_id)
+
     async def enter(self):
         message = 'Did you recall it right?'
         answers = ['Yes', 'No']
 
-        await bot.send_message(self.user_id, message, reply_markup=get_keyboard(answers))
+        await sender.send_message(self.user_id, message, reply_markup=get_keyboard(answers))
 
     @basic_input_handler(commands=['Yes', 'No'])
     async def process_msg(self, message: str):
@@ -236,27 +304,35 @@ class WordQuizState(State):
         self.word = word
         self.message_to_delete_id = message_to_delete_id
 
+    @property
+    def keyboard_message_id(self) -> int | None:
+        return self.message_to_delete_id
+
+    def to_record(self) -> StateRecord:
+        return StateRecord(type(self).__name__, self.word.word, self.word.part_of_speech, self.message_to_delete_id)
+
+    @classmethod
+    async def from_record(cls, user_id: int, record: StateRecord) -> State:
+        return cls(user_id, await storage.get_word(record.word, record.part_of_speech), record.message_id)
+
     async def enter(self):
         message = str(self.word) + '\n' + '\n'.join(self.word.en_definitions) + '\ndid you recall correctly?'
 
-        correct_dict = {'message': 'Correct'}
-        incorrect_dict = {'message': 'Incorrect'}
-
         keyboard = get_inline_keyboard([
-            ('✔', json.dumps(correct_dict)),
-            ('❌', json.dumps(incorrect_dict))
+            ('✔', self.callback_data('Correct')),
+            ('❌', self.callback_data('Incorrect'))
         ])
 
-        await bot.edit_message_text(message, self.user_id, self.message_to_delete_id, reply_markup=keyboard)
+        await sender.edit_message_text(message, self.user_id, self.message_to_delete_id, reply_markup=keyboard)
 
     @basic_input_handler(commands=['Correct', 'Incorrect'])
     async def process_msg(self, message: str) -> State:
         if message == 'Correct':
-            self.quiz.update_word(self.word, 1, 1)
+            await storage.update_word(self.quiz, self.word, 1, 1)
         else:
-            self.quiz.update_word(self.word, 0, 1)
+            await storage.update_word(self.quiz, self.word, 0, 1)
 
-        await bot.delete_message(self.user_id, self.message_to_delete_id)
+        await sender.delete_message(self.user_id, self.message_to_delete_id)
 
         return CreateWordQuizState(self.user_id)
 
@@ -264,65 +340,178 @@ class WordQuizState(State):
 class CreateWordQuizState(State):
     def __init__(self, user_id):
         super().__init__(user_id)
-        self.word = self.quiz.get_word_to_recall()
+        self.word: Word = None
         self.entry_message_id: int = None
 
     async def enter(self):
+        # chosen here rather than in __init__, as it has to be awaited
+        self.word = await storage.get_word_to_recall(self.quiz)
         message = f"{self.word}"
-        answers = [('➡', '{"message": "continue"}'), ('🏠', '{"message": "back"}')]
+        answers = [('➡', self.callback_data('continue')), ('🏠', self.callback_data('back'))]
 
-        entry_message = await bot.send_message(self.user_id, message, reply_markup=get_inline_keyboard(answers))
+        # the message of the previous card is being deleted, so this one usually ends up as its edit
+        entry_message = await sender.send_message(self.user_id, message, reply_markup=get_inline_keyboard(answers))
         self.entry_message_id = entry_message.message_id
+        storage.prefetch_word_to_recall(self.quiz, self.word)
 
     @basic_input_handler(commands=['continue'])
     async def process_msg(self, message: str):
         return WordQuizState(self.user_id, self.word, self.entry_message_id)
 
+    @property
+    def keyboard_message_id(self) -> int | None:
+        return self.entry_message_id
+
+    def to_record(self) -> StateRecord:
+        return StateRecord(type(self).__name__, self.word.word, self.word.part_of_speech, self.entry_message_id)
+
+    @classmethod
+    async def from_record(cls, user_id: int, record: StateRecord) -> State:
+        state = cls(user_id)
+        state.word = await storage.get_word(record.word, record.part_of_speech)
+        state.entry_message_id = record.message_id
+        return state
+
 
 DefaultState.next_steps = {
     'new word': InputNewWordState,
+    'import words': ImportWordsState,
     'recall': CreateWordQuizState
 }
 
 
-user_states: dict[int, State] = {}
+async def restore_state(user_id: int, record: StateRecord) -> State:
+    state_type = State.kinds.get(record.kind)
+
+    if state_type is None:
+        return DefaultState(user_id)
+
+    try:
+        return await state_type.from_record(user_id, record)
+    except WordNotFound:
+        # the word of the conversation can't be built anymore
+        return DefaultState(user_id)
+
+
+user_states: StateStore[State] = StateStore(lambda state: state.to_record(), restore_state)
+chat_dispatcher = ChatDispatcher()
 dp = aiogram.Dispatcher(bot)
 
 
+def serialized(handler: typing.Callable[[aiogram.types.Message | aiogram.types.CallbackQuery], typing.Awaitable]):
+    """
+    runs the handler through the chat dispatcher, so that updates of a chat are handled one at a time
+
+    repeated taps on a button are dropped while the first tap is handled
+    """
+    @functools.wraps(handler)
+    async def wrapper(update: aiogram.types.Message | aiogram.types.CallbackQuery):
+        if isinstance(update, aiogram.types.CallbackQuery):
+            chat_id = update.message.chat.id
+            key = (chat_id, update.message.message_id, update.data)
+        else:
+            chat_id = update.chat.id
+            key = None
+
+        return await chat_dispatcher.dispatch(chat_id, lambda: handler(update), key)
+
+    return wrapper
+
+
 @dp.message_handler(commands=['start'])
+@serialized
 async def start_handler(message: aiogram.types.Message):
     if message.chat.id not in whitelist:
-        await bot.send_message(message.chat.id, 'If you want to get access to the bot, contact @soldiersrb\n')
+        await sender.send_message(message.chat.id, 'If you want to get access to the bot, contact @soldiersrb\n')
         return
 
     user_state = DefaultState(message.chat.id)
     await user_state.enter()
-    user_states[message.chat.id] = user_state
+    await user_states.set(message.chat.id, user_state)
 
 
 @dp.message_handler()
+@serialized
 async def message_handler(message: aiogram.types.Message):
     if message.chat.id not in whitelist:
-        await bot.send_message(message.chat.id, 'If you want to get access to the bot, contact @soldiersrb\n')
+        await sender.send_message(message.chat.id, 'If you want to get access to the bot, contact @soldiersrb\n')
         return
 
-    if message.chat.id in user_states:
-        user_states[message.chat.id] = await user_states[message.chat.id].process_msg(message.text)
-        await user_states[message.chat.id].enter()
+    user_state = await user_states.get(message.chat.id)
+
+    if user_state is not None:
+        user_state = await user_state.process_msg(message.text)
+    else:
+        user_state = DefaultState(message.chat.id)
+
+    await user_state.enter()
+    await user_states.set(message.chat.id, user_state)
+
+
+@dp.message_handler(content_types=[aiogram.types.ContentType.DOCUMENT])
+@serialized
+async def document_handler(message: aiogram.types.Message):
+    if message.chat.id not in whitelist:
+        await sender.send_message(message.chat.id, 'If you want to get access to the bot, contact @soldiersrb\n')
         return
 
-    user_state = DefaultState(message.chat.id)
+    user_state = await user_states.get(message.chat.id)
+
+    if not isinstance(user_state, ImportWordsState):
+        await report_wrong_input(message.chat.id)
+        return
+
+    file = await message.document.download(destination_file=io.BytesIO())
+    user_state = await user_state.process_msg(file.getvalue().decode('utf-8', errors='replace'))
     await user_state.enter()
-    user_states[message.chat.id] = user_state
+    await user_states.set(message.chat.id, user_state)
 
 
 @dp.callback_query_handler(lambda x: 1)
+@serialized
 async def call_back_handler(query: aiogram.types.CallbackQuery):
     callback_data = json.loads(query.data)
     user_id = query.message.chat.id
-    user_states[user_id] = await user_states[user_id].process_msg(callback_data['message'])
-    await user_states[user_id].enter()
+    user_state = await user_states.get(user_id)
+
+    if user_state is None:
+        # a keyboard of a conversation that is not stored, the conversation starts over
+        user_state = DefaultState(user_id)
+    elif query.message.message_id != user_state.keyboard_message_id or \
+            callback_data.get('state', type(user_state).__name__) != type(user_state).__name__:
+        # a keyboard the conversation has moved on from, i.e. a tap that came after the first one was handled
+        return
+    else:
+        user_state = await user_state.process_msg(callback_data['message'])
+
+    await user_state.enter()
+    await user_states.set(user_id, user_state)
+
+
+async def on_shutdown(dispatcher: aiogram.Dispatcher):
+    await chat_dispatcher.close()
+    await sender.close()
+    await wiktionary_client.close()
+    print(f'wiktionary cache: {wiki_cache.stats}')
+    print(f'sender: {sender.stats}')
 
 
 if __name__ == '__main__':
-    aiogram.executor.start_polling(dp)
+    parser = argparse.ArgumentParser(description='runs the telegram bot, polling for updates by default')
+    parser.add_argument('--webhook', action='store_true', help='receive updates with a local webhook server')
+    parser.add_argument('--host', default=webhook.host)
+    parser.add_argument('--port', type=int, default=webhook.port)
+    parser.add_argument('--path', default=webhook.path)
+    parser.add_argument('--public-url', help='url telegram reaches the server at, the webhook is registered '
+                                             'with it on startup, i.e. https://example.com')
+    parser.add_argument('--secret-token', help='token telegram has to send with every update, '
+                                               'a random one is used with --public-url if not given')
+    args = parser.parse_args()
+
+    prewarm_dictionary()
+
+    if args.webhook:
+        webhook.run(dp, args.host, args.port, args.path, args.public_url, on_shutdown=on_shutdown,
+                    secret_token=args.secret_token)
+    else:
+        aiogram.executor.start_polling(dp, on_shutdown=on_shutdown)
@@ -119,7 +119,7 @@ class ConfirmAddNewWordState(State):
         self.word = word
 
     async def enter(self):
-        message = '\n'.join([self.word.__repr__()] + self.word.en_definitions + ['confirm adding this word?'])
+        message = '\n'.join([self.word.__repr__(), *self.word.en_definitions, 'confirm adding this word?'])
         answers = ['Yes', 'No']
         await bot.send_message(self.user_id, message, reply_markup=get_keyboard(answers))
 
@@ -200,7 +200,7 @@ class InputNewWordState(State):
             await bot.send_message(self.user_id, message)
             return self
 
-        if self.quiz.Table.check_user_has_word(self.user_id, word_obj):
+        if self.quiz.has_word(word_obj):
             message = "Word already in quiz"
             await bot.send_message(self.user_id, message)
             return self
@@ -0,0 +1,68 @@
+import argparse
+import os
+import sys
+import time
+
+from bs4 import BeautifulSoup as Soup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from declension_parser import DeclensionParseError, parse_declension_rows  # noqa: E402
+from word import Noun  # noqa: E402
+
+# run from the repository root: python benchmarks/declension_parse.py <directory with saved .html pages>
+repeats = 5
+
+
+def measure(function, argument) -> float:
+    """
+    best of repeats, in seconds
+    """
+    times = []
+
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(argument)
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+
+def parse_fast(html: str) -> tuple:
+    return Noun._build_noun_info(parse_declension_rows(html)[1:])
+
+
+def parse_full(html: str) -> tuple:
+    return Noun._parse_noun_info(Soup(html, features="html.parser"))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compares declension table parsing against the full page parse')
+    parser.add_argument('pages', help='directory with saved wiktionary noun pages')
+    args = parser.parse_args()
+
+    fast_total = full_total = 0.
+    pages = sorted(name for name in os.listdir(args.pages) if name.endswith('.html'))
+
+    for name in pages:
+        with open(os.path.join(args.pages, name), encoding='utf-8') as file:
+            html = file.read()
+
+        try:
+            fast_result = parse_fast(html)
+        except (DeclensionParseError, IndexError) as error:
+            print(f'{name}: fast path failed ({error!r}), falls back to the full parse')
+            continue
+
+        if fast_result != parse_full(html):
+            print(f'{name}: results differ')
+            continue
+
+        fast_time, full_time = measure(parse_fast, html), measure(parse_full, html)
+        fast_total += fast_time
+        full_total += full_time
+        print(f'{name} ({len(html) // 1024} KB): fast {fast_time * 1000:.2f} ms, full {full_time * 1000:.2f} ms')
+
+    if fast_total:
+        print(f'total: fast {fast_total * 1000:.1f} ms, full {full_total * 1000:.1f} ms, '
+              f'{full_total / fast_total:.0f}x faster')
@@ -0,0 +1,40 @@
+import os
+import statistics
+import subprocess
+import sys
+
+# run from the repository root: python benchmarks/import_time.py
+repeats = 5
+
+# the previous versions json.load-ed this file while the Word class was defined
+path_to_parsed_json = 'data/parsed_dictionary.json'
+
+cases = {
+    'import word': 'import word',
+    'import quiz': 'import quiz',
+    'import word + first lookup': 'import word\n'
+                                  'word.Word._get_most_frequent_part_of_speech("Haus")',
+}
+
+if os.path.exists(path_to_parsed_json):
+    cases['eager json dictionary load (before)'] = f'import json\n' \
+                                                  f'json.load(open("{path_to_parsed_json}", encoding="utf-8"))'
+
+
+def measure(code: str) -> float:
+    """
+    runs the code in a fresh interpreter, returns the time it took in seconds
+    """
+    script = 'import time\n' \
+             'start = time.perf_counter()\n' \
+             f'{code}\n' \
+             'print(time.perf_counter() - start)'
+
+    output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout
+    return float(output.split()[-1])
+
+
+if __name__ == '__main__':
+    for name, code in cases.items():
+        times = [measure(code) for _ in range(repeats)]
+        print(f'{name}: median {statistics.median(times) * 1000:.1f} ms, min {min(times) * 1000:.1f} ms')
@@ -0,0 +1,84 @@
+import asyncio
+import collections
+import typing
+
+T = typing.TypeVar('T')
+
+
+class ChatDispatcher:
+    """
+    runs handlers of the same chat one after another, handlers of different chats run concurrently
+
+    every chat with queued handlers has its own queue served by its own task, so an update of a chat never starts
+    before the previous update of that chat is handled, and a slow handler only holds up its own chat,
+    queues and tasks are created on demand and dropped once the chat's queue is empty
+    """
+
+    def __init__(self):
+        self._queues: dict[int, collections.deque[tuple[typing.Callable[[], typing.Awaitable], asyncio.Future]]] = {}
+        self._workers: dict[int, asyncio.Task] = {}
+        # keys of the handlers which are queued or running
+        self._pending: set[typing.Hashable] = set()
+
+    async def _work(self, chat_id: int):
+        queue = self._queues[chat_id]
+        future = None
+
+        try:
+            while queue:
+                handler, future = queue.popleft()
+
+                try:
+                    result = await handler()
+
+                    if not future.done():
+                        future.set_result(result)
+                except Exception as error:
+                    if not future.done():
+                        future.set_exception(error)
+        finally:
+            # the queue is empty here unless the worker is cancelled, the running and the queued handlers are
+            # cancelled then, so that nothing waits on them forever
+            if future is not None and not future.done():
+                future.cancel()
+
+            while queue:
+                _, future = queue.popleft()
+                future.cancel()
+
+            self._queues.pop(chat_id, None)
+            self._workers.pop(chat_id, None)
+
+    async def dispatch(self, chat_id: int, handler: typing.Callable[[], typing.Awaitable[T]],
+                       key: typing.Hashable = None) -> T | None:
+        """
+        queues the handler behind the earlier handlers of the chat and returns its result
+
+        a handler with a key is dropped and None is returned, if a handler with the same key is queued or running
+        """
+        if key is not None:
+            if key in self._pending:
+                return None
+
+            self._pending.add(key)
+
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(chat_id, collections.deque()).append((handler, future))
+
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._work(chat_id))
+
+        try:
+            return await future
+        finally:
+            self._pending.discard(key)
+
+    async def drain(self):
+        """
+        waits until all the queued handlers are handled
+        """
+        while self._workers:
+            await asyncio.gather(*self._workers.values(), return_exceptions=True)
+
+    async def close(self):
+        await self.drain()
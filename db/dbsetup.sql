@@ -27,5 +27,5 @@ CREATE TABLE quiz (
     alpha REAL,
     beta REAL,
     t REAL,
-
-);
\ No newline at end of file
+    last_review REAL
+);
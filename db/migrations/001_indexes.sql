@@ -0,0 +1,15 @@
+-- keep only the latest record of every word in a user's quiz before making the pair unique
+DELETE FROM quiz WHERE record_id NOT IN (
+    SELECT MAX(record_id) FROM quiz GROUP BY user_id, word, part_of_speech
+);
+
+-- also serves lookups by user_id alone, as it is the leftmost column
+CREATE UNIQUE INDEX IF NOT EXISTS quiz_user_word ON quiz (user_id, word, part_of_speech);
+
+CREATE INDEX IF NOT EXISTS words_word ON words (word, part_of_speech);
+
+DELETE FROM nouns WHERE record_id NOT IN (
+    SELECT MIN(record_id) FROM nouns GROUP BY word
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS nouns_word ON nouns (word);
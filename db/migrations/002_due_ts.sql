@@ -0,0 +1,6 @@
+ALTER TABLE quiz ADD COLUMN due_ts REAL;
+
+-- existing rows get their half-life as the due time, it is recomputed with the configured threshold on next review
+UPDATE quiz SET due_ts = last_review + t;
+
+CREATE INDEX IF NOT EXISTS quiz_user_due ON quiz (user_id, due_ts);
@@ -0,0 +1,13 @@
+CREATE TABLE IF NOT EXISTS wiki_cache (
+    record_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    word TEXT,
+    -- 0 for words without a wiktionary page
+    found INTEGER,
+    -- json list of the parsed declension
+    declension TEXT,
+    -- zlib compressed page, only stored if enabled
+    html BLOB,
+    fetched_at REAL
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS wiki_cache_word ON wiki_cache (word);
@@ -0,0 +1,13 @@
+-- conversation state of every telegram chat, so that conversations survive restarts
+CREATE TABLE IF NOT EXISTS telegram_states (
+    record_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    -- name of the state class
+    kind TEXT,
+    word TEXT,
+    part_of_speech TEXT,
+    message_id INTEGER,
+    updated_at REAL
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS telegram_states_user ON telegram_states (user_id);
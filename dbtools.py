@@ -1,83 +1,428 @@
+import asyncio
+import functools
+import os
 import sqlite3
+import threading
+import typing
 from contextlib import contextmanager
 
 database = 'db/spaced_repetition.db'
+path_to_setup_script = 'db/dbsetup.sql'
+path_to_migrations = 'db/migrations'
+
+busy_timeout = 5000  # ms
+cached_statements = 256
+
+
+class ConnectionManager:
+    """
+    keeps connections open instead of reconnecting on every statement
+
+    every thread gets its own connection, a running asyncio loop gets a dedicated one,
+    as sqlite connections can not be shared between threads
+    """
+
+    def __init__(self, path: str, on_first_open: typing.Callable[[sqlite3.Connection], None] = None):
+        self.path = path
+        self.on_first_open = on_first_open
+        self._opened = False
+        self._first_open_lock = threading.Lock()
+        self._local = threading.local()
+        self._loop_connections: dict[asyncio.AbstractEventLoop, sqlite3.Connection] = {}
+        self._lock = threading.Lock()
+        # transaction depth per connection, statements inside a transaction share a single commit
+        self._depth: dict[sqlite3.Connection, int] = {}
+
+    def _open(self) -> sqlite3.Connection:
+        # isolation_level=None disables implicit transactions, they are opened explicitly in transaction()
+        connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False,
+                                     cached_statements=cached_statements)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute(f'PRAGMA busy_timeout={busy_timeout}')
+        connection.execute('PRAGMA synchronous=NORMAL')
+
+        with self._lock:
+            self._depth[connection] = 0
+
+        # other threads wait until the first connection is fully set up i.e. the database is migrated
+        with self._first_open_lock:
+            if not self._opened:
+                self._opened = True
+
+                if self.on_first_open is not None:
+                    self.on_first_open(connection)
+
+        return connection
+
+    def connection(self) -> sqlite3.Connection:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+
+        if loop is not None:
+            with self._lock:
+                connection = self._loop_connections.get(loop)
+
+            if connection is None:
+                connection = self._open()
+
+                with self._lock:
+                    self._loop_connections[loop] = connection
+
+            return connection
+
+        connection = getattr(self._local, 'connection', None)
+
+        if connection is None:
+            connection = self._local.connection = self._open()
+
+        return connection
+
+    @contextmanager
+    def transaction(self) -> sqlite3.Connection:
+        """
+        groups statements into one commit, nested transactions join the outermost one
+        """
+        connection = self.connection()
+        depth = self._depth[connection]
+
+        if depth == 0:
+            connection.execute('BEGIN')
+
+        self._depth[connection] = depth + 1
+
+        try:
+            yield connection
+        except BaseException:
+            self._depth[connection] = depth
+
+            if depth == 0:
+                connection.rollback()
+
+            raise
+
+        self._depth[connection] = depth
+
+        if depth == 0:
+            connection.commit()
+
+    def close(self):
+        with self._lock:
+            connections = list(self._depth)
+            self._depth.clear()
+            self._loop_connections.clear()
+
+        self._local = threading.local()
+
+        for connection in connections:
+            connection.close()
+
+
+def migrate_database(connection: sqlite3.Connection):
+    """
+    applies scripts from the migrations folder that are newer than the database's user_version
+
+    migration file names start with their version number, i.e. 001_indexes.sql
+    """
+    tables = connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'quiz'").fetchall()
+
+    # database is not set up yet, setup_database will migrate it afterwards
+    if not tables:
+        return
+
+    version = connection.execute('PRAGMA user_version').fetchone()[0]
+
+    for file_name in sorted(os.listdir(path_to_migrations)):
+        if not file_name.endswith('.sql'):
+            continue
+
+        migration_version = int(file_name.split('_')[0])
+
+        if migration_version <= version:
+            continue
+
+        with open(os.path.join(path_to_migrations, file_name), encoding='utf-8') as file:
+            script = file.read()
+
+        # the write lock is taken at once, so another process migrating the same database, i.e. the bot and
+        # the cli started together, waits here and finds the migration applied, scripts like ALTER TABLE can't
+        # run twice
+        connection.execute('BEGIN IMMEDIATE')
+
+        try:
+            version = connection.execute('PRAGMA user_version').fetchone()[0]
+
+            if migration_version > version:
+                for statement in _split_script(script):
+                    connection.execute(statement)
+
+                connection.execute(f'PRAGMA user_version = {migration_version}')
+                version = migration_version
+        except BaseException:
+            connection.rollback()
+            raise
+
+        connection.commit()
+
+    invalidate_schemas()
+
+
+def _split_script(script: str) -> list[str]:
+    """
+    splits a script into single statements, executescript can't be used in a transaction, it commits first
+    """
+    statements = []
+    statement = ''
+
+    for line in script.splitlines(keepends=True):
+        statement += line
+
+        if sqlite3.complete_statement(statement):
+            statements.append(statement)
+            statement = ''
+
+    # trailing comments
+    if statement.strip():
+        statements.append(statement)
+
+    return statements
+
+
+connections = ConnectionManager(database, on_first_open=migrate_database)
 
 
 @contextmanager
 def get_connection() -> sqlite3.Connection:
-    with sqlite3.connect(database) as connection:
+    with connections.transaction() as connection:
         yield connection
-        connection.commit()
+
+
+transaction = connections.transaction
 
 
 def setup_database():
-    with get_connection() as connection:
-        with open('dbsetup.sql') as file:
-            script = file.read()
+    # executescript manages its own transaction, so it runs outside of transaction()
+    connection = connections.connection()
+
+    with open(path_to_setup_script) as file:
+        script = file.read()
+
+    connection.executescript(script)
+    migrate_database(connection)
+
 
-        connection.executescript(script)
+_schemas: dict[str, list[str]] = {}
 
 
 def get_schema(table_name) -> list[str]:
+    """
+    returns names of non primary key columns, introspected once per table
+    """
+    if table_name in _schemas:
+        return _schemas[table_name]
+
     with get_connection() as connection:
         query = f"PRAGMA table_info('{table_name}')"
         result = connection.execute(query).fetchall()
 
-        parsed_res = []
+    if not result:
+        raise Exception(f'table {table_name} does not exist')
 
-        for col in result:
-            # 5th element in the tuple stores weather column is a primary key
-            if not col[5]:
-                # 1st element stores the name of the column
-                parsed_res.append(col[1])
+    parsed_res = []
 
-        return parsed_res
+    for col in result:
+        # 5th element in the tuple stores weather column is a primary key
+        if not col[5]:
+            # 1st element stores the name of the column
+            parsed_res.append(col[1])
 
+    _schemas[table_name] = parsed_res
+    return parsed_res
+
+
+def invalidate_schemas():
+    """
+    has to be called after the tables were altered
+    """
+    _schemas.clear()
+    _insert_statement.cache_clear()
+    _select_statement.cache_clear()
+    _delete_statement.cache_clear()
+    _upsert_statement.cache_clear()
+    _select_many_statement.cache_clear()
 
-def run_insert(table_name: str, *args):
 
-    args = tuple(f"'{arg}'" if isinstance(arg, str) else arg for arg in args)
+def _check_columns(table_name: str, columns: typing.Iterable[str]):
+    unknown = set(columns) - set(get_schema(table_name))
 
+    if unknown:
+        raise Exception(f'unknown columns for table {table_name} - {", ".join(sorted(unknown))}')
+
+
+def _condition(columns: tuple[str, ...]) -> str:
+    return " AND ".join(f"{column} = ?" for column in columns)
+
+
+# statements are built once per (table, columns) so that their text stays the same
+# and sqlite's statement cache can reuse the compiled statement
+
+@functools.lru_cache(maxsize=None)
+def _insert_statement(table_name: str) -> str:
     schema = get_schema(table_name)
+    column_names = ", ".join(schema)
+    placeholders = ", ".join("?" * len(schema))
+    return f"INSERT INTO {table_name} ({column_names}) VALUES({placeholders});"
 
-    if len(args) != len(schema):
-        raise Exception(f'number of arguments missmatch, columns in db - {len(schema)}, arguments provided - {len(args)}')
 
-    column_names = ", ".join(map(str, schema))
-    values = ", ".join(map(str, args))
+def _order(ordered: bool) -> str:
+    # rows come in the order they were inserted in
+    return " ORDER BY rowid" if ordered else ""
 
-    query = f"INSERT INTO {table_name} ({column_names}) VALUES({values});"
 
-    with get_connection() as connection:
-        connection.execute(query)
+@functools.lru_cache(maxsize=None)
+def _select_statement(table_name: str, columns: tuple[str, ...], ordered: bool = False) -> str:
+    _check_columns(table_name, columns)
+    column_names = ", ".join(get_schema(table_name))
+    return f"SELECT {column_names} FROM {table_name} WHERE {_condition(columns)}{_order(ordered)};"
+
 
+@functools.lru_cache(maxsize=None)
+def _delete_statement(table_name: str, columns: tuple[str, ...]) -> str:
+    _check_columns(table_name, columns)
+    return f"DELETE FROM {table_name} WHERE {_condition(columns)};"
 
-def run_select(table_name: str, search_query: dict) -> list[tuple]:
+
+@functools.lru_cache(maxsize=None)
+def _upsert_statement(table_name: str, conflict_columns: tuple[str, ...]) -> str:
+    _check_columns(table_name, conflict_columns)
     schema = get_schema(table_name)
-    column_names = ", ".join(map(str, schema))
+    updates = ", ".join(f"{column} = excluded.{column}" for column in schema if column not in conflict_columns)
+    conflict = ", ".join(conflict_columns)
+    return f"{_insert_statement(table_name)[:-1]} ON CONFLICT({conflict}) DO UPDATE SET {updates};"
+
+
+@functools.lru_cache(maxsize=None)
+def _select_many_statement(table_name: str, columns: tuple[str, ...], rows_count: int, ordered: bool = False) -> str:
+    _check_columns(table_name, columns)
+    column_names = ", ".join(get_schema(table_name))
+    row = f"({', '.join('?' * len(columns))})"
+    values = ", ".join([row] * rows_count)
+    # sqlite doesn't use an index for a row value IN (VALUES ...) of several columns, but does for a subquery
+    return f"SELECT {column_names} FROM {table_name} " \
+           f"WHERE ({', '.join(columns)}) IN (SELECT * FROM (VALUES {values})){_order(ordered)};"
+
+
+def _check_row_length(table_name: str, row: tuple):
+    schema = get_schema(table_name)
+
+    if len(row) != len(schema):
+        raise Exception(f'number of arguments missmatch, columns in db - {len(schema)}, arguments provided - {len(row)}')
 
-    for key, value in search_query.items():
-        if isinstance(value, str):
-            search_query[key] = f"'{value}'"
 
-    condition = " AND ".join([f"{key} = {value}" for key, value in search_query.items()])
-    query = f"SELECT {column_names} FROM {table_name} WHERE {condition};"
+def run_insert(table_name: str, *args):
+    _check_row_length(table_name, args)
 
     with get_connection() as connection:
-        cursor = connection.execute(query)
+        connection.execute(_insert_statement(table_name), args)
+
+
+def run_insert_many(table_name: str, rows: typing.Iterable[tuple]):
+    """
+    inserts all the rows with a single executemany in one transaction
+    """
+    rows = list(rows)
+
+    for row in rows:
+        _check_row_length(table_name, row)
+
+    with get_connection() as connection:
+        connection.executemany(_insert_statement(table_name), rows)
+
+
+# rows looked up by a single statement in run_select_many
+select_many_chunk_size = 256
+
+
+def run_select_many(table_name: str, columns: tuple[str, ...], rows: typing.Iterable[tuple],
+                    ordered: bool = False) -> list[tuple]:
+    """
+    selects records matching any of the given value tuples, columns define the order of values in the tuples,
+    ordered records of a chunk come in the order they were inserted in
+
+    rows are looked up in chunks, the last chunk is padded with a repeated row so that every chunk uses the
+    same statement
+    """
+    rows = list(dict.fromkeys(tuple(row) for row in rows))
+    columns = tuple(columns)
+    res = []
+
+    if not rows:
+        return res
+
+    chunk_size = min(select_many_chunk_size, len(rows))
+    query = _select_many_statement(table_name, columns, chunk_size, ordered)
+
+    with get_connection() as connection:
+        for i in range(0, len(rows), chunk_size):
+            chunk = rows[i: i + chunk_size]
+            chunk += [chunk[-1]] * (chunk_size - len(chunk))
+            params = tuple(value for row in chunk for value in row)
+            res.extend(connection.execute(query, params).fetchall())
+
+    return res
+
+
+def run_upsert(table_name: str, conflict_columns: tuple[str, ...], *args):
+    """
+    inserts a row or updates the existing one, conflict_columns must be covered by a unique index
+    """
+    _check_row_length(table_name, args)
+
+    with get_connection() as connection:
+        connection.execute(_upsert_statement(table_name, tuple(conflict_columns)), args)
+
+
+def run_upsert_many(table_name: str, conflict_columns: tuple[str, ...], rows: typing.Iterable[tuple]):
+    """
+    upserts all the rows with a single executemany in one transaction
+    """
+    rows = list(rows)
+
+    for row in rows:
+        _check_row_length(table_name, row)
+
+    with get_connection() as connection:
+        connection.executemany(_upsert_statement(table_name, tuple(conflict_columns)), rows)
+
+
+def run_select(table_name: str, search_query: dict, ordered: bool = False) -> list[tuple]:
+    columns = tuple(search_query)
+
+    with get_connection() as connection:
+        cursor = connection.execute(_select_statement(table_name, columns, ordered), tuple(search_query.values()))
 
         return list(cursor.fetchall())
 
 
-def run_delete(table_name: str, delete_query: dict):
-    for key, value in delete_query.items():
-        if isinstance(value, str):
-            delete_query[key] = f"'{value}'"
+def run_query(query: str, params: tuple = ()) -> list[tuple]:
+    """
+    runs a custom parameterized query, for cases which don't fit the helpers above
+    """
+    with get_connection() as connection:
+        return list(connection.execute(query, params).fetchall())
 
-    condition = " AND ".join([f'{key} = {value}' for key, value in delete_query.items()])
-    query = f"DELETE FROM {table_name} WHERE {condition}"
+
+def run_delete(table_name: str, delete_query: dict):
+    columns = tuple(delete_query)
 
     with get_connection() as connection:
-        connection.execute(query)
+        connection.execute(_delete_statement(table_name, columns), tuple(delete_query.values()))
+
 
+def run_delete_many(table_name: str, columns: tuple[str, ...], rows: typing.Iterable[tuple]):
+    """
+    deletes rows matching any of the given value tuples, columns define the order of values in the tuples
+    """
+    with get_connection() as connection:
+        connection.executemany(_delete_statement(table_name, tuple(columns)), rows)
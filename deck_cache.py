@@ -0,0 +1,113 @@
+import sys
+import threading
+import typing
+from collections import OrderedDict
+
+from sampling import WeightedSampler
+
+# (word, part_of_speech)
+WordKey = tuple[str, str]
+# (ebisu tuple, last_review)
+DeckRecord = tuple[tuple[float, float, float], float]
+
+# rough size of a record apart from the strings: dict entry, tuples, floats and the sampler's entry
+_record_overhead = 400
+
+
+def _record_size(key: WordKey) -> int:
+    return _record_overhead + sys.getsizeof(key[0]) + sys.getsizeof(key[1])
+
+
+class Deck:
+    """
+    in memory copy of the user's quiz records
+    """
+
+    def __init__(self, records: typing.Iterable[tuple[WordKey, tuple[float, float, float], float]]):
+        self.records: dict[WordKey, DeckRecord] = {}
+        self.nbytes = 0
+        # held by the Quiz while it reads and writes the deck, the deck may be used from several threads
+        self.lock = threading.RLock()
+
+        # managed by the Quiz, time bucket the sampler weights were computed in
+        self.sampler = WeightedSampler()
+        self.sampler_bucket: int = None
+        # managed by the Quiz, (drawn key, key left out of the draw, sampler bucket) of the next word to recall
+        self.prefetched: tuple[WordKey, WordKey, int] = None
+
+        for key, ebisu_tuple, last_review in records:
+            self.set(key, ebisu_tuple, last_review)
+
+    def __contains__(self, key: WordKey):
+        return key in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, key: WordKey) -> DeckRecord | None:
+        return self.records.get(key)
+
+    def set(self, key: WordKey, ebisu_tuple: tuple[float, float, float], last_review: float):
+        if key not in self.records:
+            self.nbytes += _record_size(key)
+
+        self.records[key] = (tuple(ebisu_tuple), last_review)
+
+
+class DeckCache:
+    """
+    LRU of decks of active users, decks are loaded on first access
+
+    the cache doesn't write to the database itself, callers write through it:
+    update the database first, then the deck
+    """
+
+    def __init__(self, load: typing.Callable[[int], list[tuple[WordKey, tuple[float, float, float], float]]],
+                 max_bytes: int = 64 * 1024 * 1024):
+        self.load = load
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._decks: OrderedDict[int, Deck] = OrderedDict()
+        # deck sizes as of the last access, decks grow without the cache knowing
+        self._sizes: dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, user_id: int):
+        return user_id in self._decks
+
+    def get(self, user_id: int) -> Deck:
+        with self._lock:
+            deck = self._decks.get(user_id)
+
+            if deck is not None:
+                self._decks.move_to_end(user_id)
+                self.nbytes += deck.nbytes - self._sizes[user_id]
+                self._sizes[user_id] = deck.nbytes
+                self._evict()
+                return deck
+
+        # loaded without holding the lock, so that a slow load doesn't block other users
+        deck = Deck(self.load(user_id))
+
+        with self._lock:
+            # another thread may have loaded the deck in the meantime
+            if user_id in self._decks:
+                return self._decks[user_id]
+
+            self._decks[user_id] = deck
+            self._sizes[user_id] = deck.nbytes
+            self.nbytes += deck.nbytes
+            self._evict()
+            return deck
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            if user_id in self._decks:
+                self._decks.pop(user_id)
+                self.nbytes -= self._sizes.pop(user_id)
+
+    def _evict(self):
+        # the most recently used deck is kept even if it alone is over the limit
+        while self.nbytes > self.max_bytes and len(self._decks) > 1:
+            user_id, _ = self._decks.popitem(last=False)
+            self.nbytes -= self._sizes.pop(user_id)
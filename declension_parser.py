@@ -0,0 +1,87 @@
+import html.parser
+import re
+
+# class of the declension table on german wiktionary noun pages
+declension_table_class = 'wikitable float-right inflection-table flexbox hintergrundfarbe2'
+
+_declension_table_start = re.compile(
+    r'<table\b[^>]*\bclass\s*=\s*["\']' + re.escape(declension_table_class) + r'["\']', re.IGNORECASE)
+_table_tag = re.compile(r'<(/?)table\b', re.IGNORECASE)
+
+
+class DeclensionParseError(Exception):
+    pass
+
+
+def extract_declension_table(page: str) -> str:
+    """
+    returns markup of the declension table, found by scanning the page text rather than parsing all of it
+    """
+    start = _declension_table_start.search(page)
+
+    if start is None:
+        raise DeclensionParseError('declension table not found')
+
+    depth = 0
+
+    for tag in _table_tag.finditer(page, start.start()):
+        depth += -1 if tag.group(1) else 1
+
+        if depth == 0:
+            end = page.find('>', tag.end())
+            return page[start.start(): end + 1]
+
+    raise DeclensionParseError('declension table is not closed')
+
+
+class _RowsParser(html.parser.HTMLParser):
+    """
+    collects texts of the td cells of every row, the same way BeautifulSoup's .text would
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.rows: list[list[str]] = []
+        self._cell: list[str] | None = None
+        self._tables = 0
+
+    def _close_cell(self):
+        if self._cell is not None:
+            self.rows[-1].append(''.join(self._cell))
+            self._cell = None
+
+    def handle_starttag(self, tag: str, attrs):
+        if tag == 'table':
+            self._tables += 1
+
+            if self._tables > 1:
+                raise DeclensionParseError('nested tables are not supported')
+        elif tag == 'tr':
+            self._close_cell()
+            self.rows.append([])
+        elif tag in ('td', 'th'):
+            self._close_cell()
+
+            if tag == 'td':
+                if not self.rows:
+                    raise DeclensionParseError('cell outside of a row')
+
+                self._cell = []
+
+    def handle_endtag(self, tag: str):
+        if tag in ('td', 'th', 'tr', 'table'):
+            self._close_cell()
+
+    def handle_data(self, data: str):
+        if self._cell is not None:
+            self._cell.append(data)
+
+
+def parse_declension_rows(page: str) -> list[list[str]]:
+    """
+    returns texts of td cells per row of the declension table
+    """
+    parser = _RowsParser()
+    parser.feed(extract_declension_table(page))
+    parser.close()
+    return parser.rows
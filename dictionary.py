@@ -1,73 +1,304 @@
+import argparse
+import collections
+import concurrent.futures
+import hashlib
 import json
+import os
+import time
+import typing
 
 from alive_progress import alive_bar
 import re
 
+from dbtools import run_delete_many, run_insert_many, run_select_many, transaction
+from dictionary_format import get_shard, get_shard_path, shards_count, write_sharded_dictionary
+
 path_to_dictionary = "data/dictionary.txt"
 path_to_common_english_words = 'data/top10000words.txt'
+path_to_parsed_dictionary = 'data/parsed_dictionary'
+# content hash of the sources and fingerprints of every headword of the last build
+path_to_manifest = os.path.join(path_to_parsed_dictionary, 'manifest.json')
+# output of the previous versions, can be converted with --from-json instead of parsing the dump again
+path_to_parsed_json = 'data/parsed_dictionary.json'
+
+
+# lines parsed by a worker at once
+chunk_size = 20000
+# chunks submitted to the pool ahead of the one being merged, bounds the memory used by pending chunks
+chunks_in_flight = 2 * (os.cpu_count() or 1)
+
+gender_annotation = re.compile(" [{][fmn][}]")
+context_annotation = re.compile(r'\[[^]]+]')
+spaced_context_annotation = re.compile(r' \[[^]]+]')
+
+# set in every worker process by _init_worker
+_common_words: set[str] = set()
+
+# word -> part of speech -> (whether translations are common words, translations)
+PartialDictionary = dict[str, dict[str, tuple[bool, list[str]]]]
+
+
+def _init_worker(common_words: set[str]):
+    global _common_words
+    _common_words = common_words
+
+
+def _read_chunks(path: str) -> typing.Iterator[list[str]]:
+    with open(path, 'r', encoding='utf-8') as file:
+        chunk = []
+
+        for line in file:
+            chunk.append(line.rstrip('\n'))
+
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+
+        if chunk:
+            yield chunk
+
+
+def _parse_chunk(lines: list[str]) -> PartialDictionary:
+    """
+    parses lines of the dict.cc dump
+
+    translations which are common english words are kept separately, once a part of speech has one
+    the obscure translations are dropped, as they won't make it to the final dictionary
+    """
+    definition_dictionary: dict[str, dict[str, tuple[list[str], list[str]]]] = {}
+
+    for word in lines:
+        is_comment = word.startswith('#') or not word
+
+        if is_comment:
+            continue
+
+        german_word, english_definition, part_of_speech, *_ = word.split('\u0009')
+
+        # remove the feminine/masculine/neutral annotation
+        german_word = gender_annotation.sub("", german_word)
+
+        # remove "to"
+        if part_of_speech == 'verb':
+            english_definition = " ".join(english_definition.split()[1:])
+
+        # i.e. laufen    to troll [esp. Br.] [coll.] [walk]	verb
+        context = context_annotation.findall(english_definition)
+        english_definition = spaced_context_annotation.sub('', english_definition)
+
+        # join the translation and the context back
+        translation = english_definition + " " + " ".join(context)
+
+        all_translations, common_translations = definition_dictionary.setdefault(german_word, {}).setdefault(
+            part_of_speech, ([], []))
+
+        if english_definition in _common_words:
+            common_translations.append(translation)
+        elif not common_translations:
+            all_translations.append(translation)
+
+    return {
+        word: {
+            part_of_speech: (True, common) if common else (False, all_)
+            for part_of_speech, (all_, common) in parts_of_speech.items()
+        }
+        for word, parts_of_speech in definition_dictionary.items()
+    }
+
+
+def _merge(definition_dictionary: PartialDictionary, partial: PartialDictionary):
+    """
+    merges a later chunk into the dictionary, filtering out obscure english definitions on the way
+    """
+    for word, parts_of_speech in partial.items():
+        word_entry = definition_dictionary.setdefault(word, {})
+
+        for part_of_speech, (is_common, translations) in parts_of_speech.items():
+            if part_of_speech not in word_entry:
+                word_entry[part_of_speech] = (is_common, translations)
+                continue
+
+            merged_is_common, merged_translations = word_entry[part_of_speech]
+
+            if is_common and not merged_is_common:
+                word_entry[part_of_speech] = (True, translations)
+            elif is_common == merged_is_common:
+                merged_translations.extend(translations)
 
 
 def parse_dictionary() -> dict[str, dict[str, list[str]]]:
+    """
+    streams the dict.cc dump in chunks which are parsed by a process pool and merged in the file order
+    """
     with open(path_to_common_english_words, 'r', encoding='utf-8') as file:
         common_words = set(file.read().split('\n'))
 
-    with open(path_to_dictionary, 'r', encoding='utf-8') as file:
-        raw_data_string = file.read()
+    definition_dictionary: PartialDictionary = {}
+    lines_count = 0
+    start = time.perf_counter()
 
-    words_data = raw_data_string.split('\n')
-    definition_dictionary = {}
+    with concurrent.futures.ProcessPoolExecutor(initializer=_init_worker, initargs=(common_words,)) as executor, \
+            alive_bar() as bar:
+        pending: collections.deque[tuple[int, concurrent.futures.Future]] = collections.deque()
 
-    with alive_bar(len(words_data)) as bar:
-        for word in words_data:
-            bar()
-            is_comment = word.startswith('#') or not word
+        for chunk in _read_chunks(path_to_dictionary):
+            pending.append((len(chunk), executor.submit(_parse_chunk, chunk)))
 
-            if is_comment:
-                continue
+            if len(pending) >= chunks_in_flight:
+                chunk_length, future = pending.popleft()
+                _merge(definition_dictionary, future.result())
+                lines_count += chunk_length
+                bar(chunk_length)
+
+        while pending:
+            chunk_length, future = pending.popleft()
+            _merge(definition_dictionary, future.result())
+            lines_count += chunk_length
+            bar(chunk_length)
+
+    elapsed = time.perf_counter() - start
+    print(f'parsed {lines_count} lines in {elapsed:.1f} s, {lines_count / elapsed:.0f} lines/s')
+
+    return {
+        word: {part_of_speech: translations for part_of_speech, (_, translations) in parts_of_speech.items()}
+        for word, parts_of_speech in definition_dictionary.items()
+    }
+
+
+def hash_files(*paths: str) -> str:
+    digest = hashlib.sha256()
+
+    for path in paths:
+        with open(path, 'rb') as file:
+            while block := file.read(1024 * 1024):
+                digest.update(block)
+
+    return digest.hexdigest()
+
+
+def get_fingerprint(entry: dict[str, list[str]]) -> str:
+    # order of the parts of speech matters, it decides the most frequent one on a tie
+    return hashlib.blake2b(json.dumps(entry, ensure_ascii=False).encode('utf-8'), digest_size=8).hexdigest()
+
+
+def load_manifest() -> dict | None:
+    if not os.path.exists(path_to_manifest):
+        return None
+
+    with open(path_to_manifest, 'r', encoding='utf-8') as file:
+        manifest = json.load(file)
 
-            german_word, english_definition, part_of_speech, *_ = word.split('\u0009')
+    if manifest.get('shards_count') != shards_count:
+        return None
 
-            # remove the feminine/masculine/neutral annotation
-            german_word = re.sub(" [{][fmn][}]", "", german_word)
+    return manifest
 
-            if german_word not in definition_dictionary:
-                definition_dictionary[german_word] = {}
 
-            if part_of_speech not in definition_dictionary[german_word]:
-                definition_dictionary[german_word][part_of_speech] = []
+class BuildReport(typing.NamedTuple):
+    added: set[str]
+    removed: set[str]
+    changed: set[str]
+    rewritten_shards: set[int]
 
-            # remove "to"
-            if part_of_speech == 'verb':
-                english_definition = " ".join(english_definition.split()[1:])
 
-            # i.e. laufen    to troll [esp. Br.] [coll.] [walk]	verb
-            context = re.findall('\[[^]]+]', english_definition)
-            english_definition = re.sub(' \[[^]]+]', '', english_definition)
+def write_incrementally(def_dict: dict[str, dict[str, list[str]]], source_hash: str) -> BuildReport:
+    """
+    compares headword fingerprints with the previous build and rewrites only the shards with changed headwords
+    """
+    manifest = load_manifest()
+    old_fingerprints: dict[str, str] = manifest['fingerprints'] if manifest else {}
+    fingerprints = {word: get_fingerprint(entry) for word, entry in def_dict.items()}
 
-            definition_dictionary[german_word][part_of_speech].append((english_definition, context))
+    added = fingerprints.keys() - old_fingerprints.keys()
+    removed = old_fingerprints.keys() - fingerprints.keys()
+    changed = {word for word in fingerprints.keys() & old_fingerprints.keys()
+               if fingerprints[word] != old_fingerprints[word]}
 
-    for word in definition_dictionary:
-        for part_of_speech in definition_dictionary[word]:
-            common_translations = list(
-                filter(lambda record: record[0] in common_words, definition_dictionary[word][part_of_speech]))
+    shards = {get_shard(word) for word in added | removed | changed}
+    # shards which are missing on disk, i.e. on the first build
+    shards.update(shard for shard in range(shards_count)
+                  if manifest is None or not os.path.exists(get_shard_path(path_to_parsed_dictionary, shard)))
 
-            # filter out obscure english definitions
-            if common_translations:
-                definition_dictionary[word][part_of_speech] = common_translations
+    write_sharded_dictionary(def_dict, path_to_parsed_dictionary, shards)
 
-            # join the translation and the context back
-            translations = []
+    with open(path_to_manifest, 'w', encoding='utf-8') as file:
+        json.dump({'source_hash': source_hash, 'shards_count': shards_count, 'fingerprints': fingerprints}, file)
 
-            for translation in definition_dictionary[word][part_of_speech]:
-                translations.append(translation[0] + " " + " ".join(translation[1]))
+    return BuildReport(added, removed, changed, shards)
 
-            definition_dictionary[word][part_of_speech] = translations
 
-    return definition_dictionary
+def find_stale_definitions(words: typing.Iterable[str], def_dict: dict[str, dict[str, list[str]]]) \
+        -> tuple[list[tuple[str, str]], list[tuple[str, str]]]:
+    """
+    returns (stale, removed) lists of (word, part_of_speech) stored in the words table
+
+    stale ones have different definitions in the new dictionary, removed ones are not in it anymore
+    """
+    stored: dict[tuple[str, str], list[str]] = {}
+
+    for word, part_of_speech, definition in run_select_many('words', ('word',), ((word,) for word in words)):
+        stored.setdefault((word, part_of_speech), []).append(definition)
+
+    stale = []
+    removed = []
+
+    for (word, part_of_speech), definitions in stored.items():
+        new_definitions = def_dict.get(word, {}).get(part_of_speech)
+
+        if new_definitions is None:
+            removed.append((word, part_of_speech))
+        elif new_definitions != definitions:
+            stale.append((word, part_of_speech))
+
+    return stale, removed
+
+
+def refresh_stale_definitions(stale: list[tuple[str, str]], def_dict: dict[str, dict[str, list[str]]]):
+    """
+    replaces stored definitions with the ones from the new dictionary in a single transaction
+    """
+    with transaction():
+        run_delete_many('words', ('word', 'part_of_speech'), stale)
+        run_insert_many('words', ((word, part_of_speech, definition)
+                                  for word, part_of_speech in stale
+                                  for definition in def_dict[word][part_of_speech]))
 
 
 if __name__ == '__main__':
-    def_dict = parse_dictionary()
+    parser = argparse.ArgumentParser(description='builds the dictionary out of the dict.cc dump')
+    parser.add_argument('--from-json', action='store_true',
+                        help=f'convert {path_to_parsed_json} of the previous versions instead of parsing the dump')
+    parser.add_argument('--force', action='store_true', help='rebuild even if the sources did not change')
+    parser.add_argument('--refresh-stale', action='store_true',
+                        help='replace stale definitions stored in the database')
+    args = parser.parse_args()
+
+    sources = [path_to_parsed_json] if args.from_json else [path_to_dictionary, path_to_common_english_words]
+    source_hash = hash_files(*sources)
+    manifest = load_manifest()
+
+    if not args.force and manifest is not None and manifest['source_hash'] == source_hash:
+        print('dictionary is up to date')
+        raise SystemExit
+
+    if args.from_json:
+        with open(path_to_parsed_json, 'r', encoding='utf-8') as file:
+            def_dict = json.load(file)
+    else:
+        def_dict = parse_dictionary()
+
+    report = write_incrementally(def_dict, source_hash)
+    print(f'headwords added - {len(report.added)}, removed - {len(report.removed)}, changed - {len(report.changed)}, '
+          f'shards rewritten - {len(report.rewritten_shards)}/{shards_count}')
+
+    stale, removed = find_stale_definitions(report.changed | report.removed, def_dict)
+
+    for word, part_of_speech in stale:
+        print(f'stale definitions: {word} [{part_of_speech}]')
+
+    for word, part_of_speech in removed:
+        print(f'not in the dictionary anymore: {word} [{part_of_speech}]')
 
-    with open('data/parsed_dictionary.json', 'w', encoding='utf-8') as file:
-        json.dump(def_dict, file)
+    if stale and args.refresh_stale:
+        refresh_stale_definitions(stale, def_dict)
+        print(f'refreshed definitions of {len(stale)} words')
@@ -0,0 +1,331 @@
+import mmap
+import os
+import struct
+import threading
+import typing
+import zlib
+
+# binary dictionary layout, all integers are little endian:
+#
+# header:
+#     magic, version, headwords count, parts of speech count,
+#     offsets of the part of speech table, headword offsets, entry offsets, headwords and entries sections
+# part of speech table:
+#     (u16 length, utf-8 bytes) per distinct part of speech, entries refer to them by index
+# headword offsets:
+#     (count + 1) u32 offsets into the headwords section, headword i spans offsets[i]:offsets[i + 1]
+# entry offsets:
+#     count u32 offsets into the entries section
+# headwords:
+#     utf-8 headwords sorted by their bytes, each stored once
+# entries:
+#     u8 index of the most frequent part of speech in the entry, u8 parts of speech count,
+#     then per part of speech: u8 part of speech index, u16 definitions count, (u16 length, utf-8 bytes) per definition
+
+magic = b'GSRD'
+version = 1
+
+# a dictionary is split into shard files by a hash of the headword, so that a rebuild only rewrites
+# the shards whose headwords changed
+shards_count = 64
+
+_header = struct.Struct('<4sIII5I')
+_u8 = struct.Struct('<B')
+_u16 = struct.Struct('<H')
+_u32 = struct.Struct('<I')
+
+
+def get_most_frequent_part_of_speech(entry: dict[str, list[str]]) -> str:
+    """
+    part of speech with the most definitions, the latest one wins a tie
+    """
+    return sorted(list(entry.items()), key=lambda x: len(x[1]))[-1][0]
+
+
+def _encode_string(string: str) -> bytes:
+    encoded = string.encode('utf-8')
+    return _u16.pack(len(encoded)) + encoded
+
+
+def write_dictionary(dictionary: dict[str, dict[str, list[str]]], path: str):
+    encoded_words = sorted((word.encode('utf-8'), word) for word in dictionary)
+    parts_of_speech: dict[str, int] = {}
+
+    headword_offsets = [0]
+    entry_offsets = []
+    headwords = bytearray()
+    entries = bytearray()
+
+    for encoded_word, word in encoded_words:
+        entry = dictionary[word]
+
+        headwords += encoded_word
+        headword_offsets.append(len(headwords))
+        entry_offsets.append(len(entries))
+
+        most_frequent = list(entry).index(get_most_frequent_part_of_speech(entry))
+        entries += _u8.pack(most_frequent) + _u8.pack(len(entry))
+
+        for part_of_speech, definitions in entry.items():
+            pos_index = parts_of_speech.setdefault(part_of_speech, len(parts_of_speech))
+            entries += _u8.pack(pos_index) + _u16.pack(len(definitions))
+
+            for definition in definitions:
+                entries += _encode_string(definition)
+
+    pos_table = b''.join(_encode_string(part_of_speech) for part_of_speech in parts_of_speech)
+    headword_offsets_section = b''.join(map(_u32.pack, headword_offsets))
+    entry_offsets_section = b''.join(map(_u32.pack, entry_offsets))
+
+    sections = [pos_table, headword_offsets_section, entry_offsets_section, headwords, entries]
+    offsets = []
+    position = _header.size
+
+    for section in sections:
+        offsets.append(position)
+        position += len(section)
+
+    if position >= 2 ** 32:
+        raise ValueError('dictionary is too large for 32 bit offsets')
+
+    # written next to the target and moved over it, so that readers never see a half written file
+    # and already mapped copies stay valid
+    temporary_path = f'{path}.tmp'
+
+    with open(temporary_path, 'wb') as file:
+        file.write(_header.pack(magic, version, len(encoded_words), len(parts_of_speech), *offsets))
+
+        for section in sections:
+            file.write(section)
+
+    os.replace(temporary_path, path)
+
+
+def get_shard(word: str, shards: int = shards_count) -> int:
+    return zlib.crc32(word.encode('utf-8')) % shards
+
+
+def get_shard_path(directory: str, shard: int) -> str:
+    return os.path.join(directory, f'shard_{shard:02}.bin')
+
+
+def write_sharded_dictionary(dictionary: dict[str, dict[str, list[str]]], directory: str,
+                             shards: typing.Iterable[int] = None):
+    """
+    writes the given shards of the dictionary, all of them by default
+    """
+    shards = set(range(shards_count) if shards is None else shards)
+    split: dict[int, dict[str, dict[str, list[str]]]] = {shard: {} for shard in shards}
+
+    for word, entry in dictionary.items():
+        shard = get_shard(word)
+
+        if shard in split:
+            split[shard][word] = entry
+
+    os.makedirs(directory, exist_ok=True)
+
+    for shard, shard_dictionary in split.items():
+        write_dictionary(shard_dictionary, get_shard_path(directory, shard))
+
+
+class MappedDictionary:
+    """
+    read only dictionary over a memory mapped file written by write_dictionary
+
+    lookups binary search the sorted headwords directly in the mapped buffer, so nothing is parsed upfront
+    and processes opening the same file share its pages
+    """
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as file:
+            self._buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        file_magic, file_version, self._count, pos_count, pos_table, self._headword_offsets, self._entry_offsets, \
+            self._headwords, self._entries = _header.unpack_from(self._buffer)
+
+        if file_magic != magic or file_version != version:
+            raise ValueError(f'{path} is not a dictionary of version {version}')
+
+        self._parts_of_speech = []
+        position = pos_table
+
+        for _ in range(pos_count):
+            part_of_speech, position = self._read_string(position)
+            self._parts_of_speech.append(part_of_speech)
+
+    def close(self):
+        self._buffer.close()
+
+    def prewarm(self):
+        """
+        reads the whole mapping once so that later lookups don't hit page faults
+        """
+        if hasattr(mmap, 'MADV_WILLNEED'):
+            self._buffer.madvise(mmap.MADV_WILLNEED)
+
+        for position in range(0, len(self._buffer), mmap.PAGESIZE):
+            self._buffer[position]
+
+    def __len__(self):
+        return self._count
+
+    def _read_string(self, position: int) -> tuple[str, int]:
+        length, = _u16.unpack_from(self._buffer, position)
+        position += _u16.size
+        return self._buffer[position: position + length].decode('utf-8'), position + length
+
+    def _get_headword(self, index: int) -> bytes:
+        start, end = struct.unpack_from('<II', self._buffer, self._headword_offsets + index * _u32.size)
+        return self._buffer[self._headwords + start: self._headwords + end]
+
+    def _find(self, word: str) -> int | None:
+        encoded_word = word.encode('utf-8')
+        low, high = 0, self._count
+
+        while low < high:
+            middle = (low + high) // 2
+
+            if self._get_headword(middle) < encoded_word:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < self._count and self._get_headword(low) == encoded_word:
+            return low
+
+        return None
+
+    def _entry_position(self, index: int) -> int:
+        offset, = _u32.unpack_from(self._buffer, self._entry_offsets + index * _u32.size)
+        return self._entries + offset
+
+    def _read_entry(self, index: int) -> typing.Iterator[tuple[str, int, int]]:
+        """
+        yields (part of speech, definitions count, position of the first definition)
+        """
+        position = self._entry_position(index) + _u8.size
+        pos_count, = _u8.unpack_from(self._buffer, position)
+        position += _u8.size
+
+        for _ in range(pos_count):
+            pos_index, = _u8.unpack_from(self._buffer, position)
+            definitions_count, = _u16.unpack_from(self._buffer, position + _u8.size)
+            position += _u8.size + _u16.size
+            yield self._parts_of_speech[pos_index], definitions_count, position
+
+            for _ in range(definitions_count):
+                length, = _u16.unpack_from(self._buffer, position)
+                position += _u16.size + length
+
+    def _read_definitions(self, position: int, count: int) -> list[str]:
+        definitions = []
+
+        for _ in range(count):
+            definition, position = self._read_string(position)
+            definitions.append(definition)
+
+        return definitions
+
+    def __contains__(self, word: str):
+        return self._find(word) is not None
+
+    def __getitem__(self, word: str) -> dict[str, list[str]]:
+        index = self._find(word)
+
+        if index is None:
+            raise KeyError(word)
+
+        return {part_of_speech: self._read_definitions(position, count)
+                for part_of_speech, count, position in self._read_entry(index)}
+
+    def get_definitions(self, word: str, part_of_speech: str) -> list[str] | None:
+        index = self._find(word)
+
+        if index is None:
+            return None
+
+        for entry_part_of_speech, count, position in self._read_entry(index):
+            if entry_part_of_speech == part_of_speech:
+                return self._read_definitions(position, count)
+
+        return None
+
+    def get_most_frequent_part_of_speech(self, word: str) -> str | None:
+        index = self._find(word)
+
+        if index is None:
+            return None
+
+        pos_index, = _u8.unpack_from(self._buffer, self._entry_position(index))
+        part_of_speech, _, _ = list(self._read_entry(index))[pos_index]
+        return part_of_speech
+
+    def __iter__(self) -> typing.Iterator[str]:
+        for i in range(self._count):
+            yield self._get_headword(i).decode('utf-8')
+
+    def items(self) -> typing.Iterator[tuple[str, dict[str, list[str]]]]:
+        for i in range(self._count):
+            entry = {part_of_speech: self._read_definitions(position, count)
+                     for part_of_speech, count, position in self._read_entry(i)}
+            yield self._get_headword(i).decode('utf-8'), entry
+
+
+class ShardedDictionary:
+    """
+    dictionary written by write_sharded_dictionary, shards are mapped on first lookup that needs them
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._shards: dict[int, MappedDictionary] = {}
+        self._lock = threading.Lock()
+
+    def _get_shard(self, shard: int) -> MappedDictionary:
+        if shard not in self._shards:
+            with self._lock:
+                if shard not in self._shards:
+                    self._shards[shard] = MappedDictionary(get_shard_path(self.directory, shard))
+
+        return self._shards[shard]
+
+    def _get_word_shard(self, word: str) -> MappedDictionary:
+        return self._get_shard(get_shard(word))
+
+    def close(self):
+        with self._lock:
+            for shard in self._shards.values():
+                shard.close()
+
+            self._shards.clear()
+
+    def prewarm(self):
+        for shard in range(shards_count):
+            self._get_shard(shard).prewarm()
+
+    def __len__(self):
+        return sum(len(self._get_shard(shard)) for shard in range(shards_count))
+
+    def __contains__(self, word: str):
+        return word in self._get_word_shard(word)
+
+    def __getitem__(self, word: str) -> dict[str, list[str]]:
+        return self._get_word_shard(word)[word]
+
+    def get_definitions(self, word: str, part_of_speech: str) -> list[str] | None:
+        return self._get_word_shard(word).get_definitions(word, part_of_speech)
+
+    def get_most_frequent_part_of_speech(self, word: str) -> str | None:
+        return self._get_word_shard(word).get_most_frequent_part_of_speech(word)
+
+    def __iter__(self) -> typing.Iterator[str]:
+        """
+        headwords are sorted only within a shard
+        """
+        for shard in range(shards_count):
+            yield from self._get_shard(shard)
+
+    def items(self) -> typing.Iterator[tuple[str, dict[str, list[str]]]]:
+        for shard in range(shards_count):
+            yield from self._get_shard(shard).items()
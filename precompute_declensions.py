@@ -0,0 +1,151 @@
+import argparse
+import asyncio
+import json
+import os
+import typing
+
+from alive_progress import alive_bar
+
+import wiki_cache
+from dbtools import transaction
+from dictionary import load_manifest
+from declension_parser import DeclensionParseError
+from word import Noun, get_dictionary
+from wiktionary import PageNotFound, WiktionaryClient, per_host_limit
+
+# index of the next noun to fetch, nouns are walked in the dictionary's order which is stable between runs
+# of the same dictionary build, so the checkpoint keeps the hash of the dictionary's source as well
+path_to_checkpoint = 'data/declensions_checkpoint.json'
+
+# nouns fetched and written to the database in one transaction
+batch_size = 500
+
+
+class BatchReport(typing.NamedTuple):
+    found: list[tuple]
+    not_found: list[str]
+    failed: list[str]
+
+
+def get_nouns() -> list[str]:
+    return [word for word, entry in get_dictionary().items() if Noun.part_of_speech_tag in entry]
+
+
+def get_source_hash() -> str | None:
+    manifest = load_manifest()
+    return manifest['source_hash'] if manifest is not None else None
+
+
+def load_checkpoint(source_hash: str | None) -> int:
+    """
+    returns 0 if the dictionary was rebuilt since the checkpoint, the positions of the nouns may have shifted
+    """
+    if not os.path.exists(path_to_checkpoint):
+        return 0
+
+    with open(path_to_checkpoint, 'r', encoding='utf-8') as file:
+        checkpoint = json.load(file)
+
+    if checkpoint.get('source_hash') != source_hash:
+        return 0
+
+    return checkpoint['position']
+
+
+def save_checkpoint(position: int, source_hash: str | None):
+    temporary_path = f'{path_to_checkpoint}.tmp'
+
+    with open(temporary_path, 'w', encoding='utf-8') as file:
+        json.dump({'position': position, 'source_hash': source_hash}, file)
+
+    os.replace(temporary_path, path_to_checkpoint)
+
+
+def get_missing(words: list[str]) -> list[str]:
+    """
+    leaves out nouns with a fresh cache entry, stored declensions are fetched again once their entries expire
+    """
+    known = Noun.Table.get_words_info(words)
+    cached = wiki_cache.Table.get_many(words)
+
+    return [word for word in words
+            if word not in cached or wiki_cache.is_expired(cached[word]) or
+            (cached[word].found and word not in known)]
+
+
+async def fetch_batch(words: list[str], client: WiktionaryClient, semaphore: asyncio.Semaphore) -> BatchReport:
+    report = BatchReport([], [], [])
+
+    async def fetch(word: str):
+        async with semaphore:
+            try:
+                html = await client.fetch_page(word)
+            except PageNotFound:
+                report.not_found.append(word)
+                return
+            except Exception:
+                # a single word must not abort the batch, the checkpoint would never move past it
+                report.failed.append(word)
+                return
+
+        try:
+            report.found.append((word, *Noun._parse_noun_page(html)))
+        except DeclensionParseError:
+            # the page exists, but doesn't have a declension table of the expected shape
+            report.failed.append(word)
+
+    await asyncio.gather(*(fetch(word) for word in words))
+    return report
+
+
+def write_batch(report: BatchReport):
+    with transaction():
+        Noun.Table.add_words(report.found)
+        wiki_cache.Table.put_many([(row[0], row[1:]) for row in report.found] +
+                                  [(word, None) for word in report.not_found])
+
+
+async def precompute(concurrency: int, url: str = None, restart: bool = False):
+    nouns = get_nouns()
+    source_hash = get_source_hash()
+    position = 0 if restart else load_checkpoint(source_hash)
+    client = WiktionaryClient(url, limit_per_host=concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+    found = not_found = 0
+    failed = []
+
+    try:
+        with alive_bar(len(nouns)) as bar:
+            bar(position, skipped=True)
+
+            for start in range(position, len(nouns), batch_size):
+                batch = nouns[start: start + batch_size]
+                report = await fetch_batch(get_missing(batch), client, semaphore)
+                write_batch(report)
+                save_checkpoint(start + len(batch), source_hash)
+
+                found += len(report.found)
+                not_found += len(report.not_found)
+                failed.extend(report.failed)
+                bar(len(batch))
+    finally:
+        await client.close()
+
+    print(f'nouns - {len(nouns)}, declensions stored - {found}, pages not found - {not_found}, '
+          f'failed - {len(failed)}')
+
+    for word in failed:
+        print(f'failed: {word}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='fetches declensions of every noun in the dictionary from wiktionary into the database')
+    parser.add_argument('--concurrency', type=int, default=per_host_limit, help='simultaneous requests')
+    parser.add_argument('--url', help='base url of the pages, i.e. of a local mirror, defaults to WIKTIONARY_URL')
+    parser.add_argument('--restart', action='store_true',
+                        help='walk all the nouns again instead of continuing from the checkpoint, '
+                             'nouns which are already stored are still skipped')
+    args = parser.parse_args()
+
+    asyncio.run(precompute(args.concurrency, args.url, args.restart))
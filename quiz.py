@@ -1,12 +1,18 @@
+import argparse
 import random
-import re
+import sys
 import time
+import typing
 
 import ebisu
+import numpy as np
 
-from word import Word, WordNotFound
+from word import Word, WordNotFound, parse_word_input
 from CliUtils import CliBlock
-from dbtools import run_insert, run_select, run_delete
+from dbtools import run_query, run_select, run_upsert, run_upsert_many, transaction
+from recall import predict_recall_models
+from deck_cache import Deck, DeckCache
+from sampling import WeightedSampler
 
 
 class WordNotInQuiz(Exception):
@@ -15,113 +21,319 @@ class WordNotInQuiz(Exception):
         super().__init__(message)
 
 
+class ImportReport(typing.NamedTuple):
+    added: list[Word]
+    # input lines
+    already_in_quiz: list[str]
+    failed: list[tuple[str, Exception]]
+
+    def __str__(self):
+        return self.format()
+
+    def format(self, max_length: int = None) -> str:
+        """
+        failures that don't fit into max_length characters are only counted
+        """
+        lines = [f'added - {len(self.added)}, already in quiz - {len(self.already_in_quiz)}, '
+                 f'failed - {len(self.failed)}']
+        length = len(lines[0])
+
+        for i, (line, error) in enumerate(self.failed):
+            failure = f'{line}: {error}'
+            rest = f'and {len(self.failed) - i} more'
+
+            # room is left for the line counting the rest
+            if max_length is not None and length + len(failure) + len(rest) + 2 > max_length:
+                lines.append(rest)
+                break
+
+            lines.append(failure)
+            length += len(failure) + 1
+
+        return '\n'.join(lines)
+
+
 class Quiz:
     half_life = 60 * 60 * 24  # a day
 
+    # recall weights are recomputed once per this many seconds, not on every draw
+    weight_refresh_interval = 60 * 60
+
     class Table:
         _table_name = 'quiz'
+        _unique_columns = ('user_id', 'word', 'part_of_speech')
+
+        # word is due when the predicted recall drops to this value
+        recall_threshold = 0.5
 
         @classmethod
-        def add_new_record(cls, user_id: int, word: Word, ebisu_tuple: tuple[float, float, float]):
-            run_insert(cls._table_name, user_id, word.word, word.part_of_speech, *ebisu_tuple, time.time())
+        def get_due_ts(cls, ebisu_tuple: tuple[float, float, float], last_review: float) -> float:
+            return last_review + ebisu.modelToPercentileDecay(ebisu_tuple, cls.recall_threshold)
 
         @classmethod
-        def get_all_user_words(cls, user_id: int) -> list[tuple[Word, tuple[float, float, float], float]]:
-            """
-            returns list[word, ebisu, t_elapsed]
+        def _upsert(cls, user_id: int, word: Word, ebisu_tuple: tuple[float, float, float]) -> float:
+            last_review = time.time()
+            due_ts = cls.get_due_ts(ebisu_tuple, last_review)
+            run_upsert(cls._table_name, cls._unique_columns,
+                       user_id, word.word, word.part_of_speech, *ebisu_tuple, last_review, due_ts)
+            return last_review
 
-            where word is Word object
-            ebisu is ebisu tuple
-            t_elapsed is time elapsed from last recall, in seconds
+        @classmethod
+        def add_new_record(cls, user_id: int, word: Word, ebisu_tuple: tuple[float, float, float]) -> float:
             """
-            res = run_select(cls._table_name, {
-                'user_id': user_id
-            })
-
-            parsed_res = []
-
-            for row in res:
-                word = row[1]
-                part_of_speech = row[2]
-                ebisu_tuple = row[3: 6]
-                t_elapsed = time.time() - row[6]
-                parsed_res.append((Word(word, part_of_speech), ebisu_tuple, t_elapsed))
-
-            return parsed_res
+            returns the last_review timestamp that was stored
+            """
+            return cls._upsert(user_id, word, ebisu_tuple)
 
         @classmethod
-        def update_word(cls, user_id: int, word: Word, new_ebisu_tuple: tuple[float, float, float]):
-            run_delete(cls._table_name, {
-                'word': word.word,
-                'part_of_speech': word.part_of_speech,
-                'user_id': user_id
-            })
-
-            run_insert(cls._table_name, user_id, word.word, word.part_of_speech, *new_ebisu_tuple, time.time())
+        def add_new_records(cls, user_id: int, words: list[Word], ebisu_tuple: tuple[float, float, float]) -> float:
+            """
+            stores all the words with a single executemany in one transaction, returns the last_review timestamp
+            """
+            last_review = time.time()
+            due_ts = cls.get_due_ts(ebisu_tuple, last_review)
+            run_upsert_many(cls._table_name, cls._unique_columns,
+                            ((user_id, word.word, word.part_of_speech, *ebisu_tuple, last_review, due_ts)
+                             for word in words))
+            return last_review
 
         @classmethod
-        def get_word_info(cls, user_id: int, word: Word) -> tuple[Word, tuple[float, float, float], float]:
+        def update_word(cls, user_id: int, word: Word, new_ebisu_tuple: tuple[float, float, float]) -> float:
             """
-            returns (word, ebisu, t_elapsed)
-
-            where word is Word object
-            ebisu is ebisu tuple
-            t_elapsed is time elapsed from last recall, in seconds
+            returns the last_review timestamp that was stored
             """
-            res = run_select(cls._table_name, {
-                'user_id': user_id,
-                'word': word.word,
-                'part_of_speech': word.part_of_speech
-            })
+            return cls._upsert(user_id, word, new_ebisu_tuple)
 
-            if not res:
-                raise WordNotInQuiz(word.word, user_id)
+        @classmethod
+        def get_most_due_word(cls, user_id: int) -> Word:
+            """
+            returns the word whose predicted recall was the first to cross the recall threshold
+            """
+            res = run_query(f"SELECT word, part_of_speech FROM {cls._table_name} WHERE user_id = ? "
+                            f"ORDER BY due_ts LIMIT 1;", (user_id,))
 
-            word = res[0][1]
-            part_of_speech = res[0][2]
-            ebisu_tuple = res[0][3: 6]
-            t_elapsed = time.time() - res[0][6]
-            return Word(word, part_of_speech), ebisu_tuple, t_elapsed
+            word, part_of_speech = res[0]
+            return Word(word, part_of_speech)
 
         @classmethod
-        def check_user_has_word(cls, user_id, word: Word):
+        def get_user_models(cls, user_id: int) -> list[tuple[tuple[str, str], tuple[float, float, float], float]]:
+            """
+            returns list[(word, part_of_speech), ebisu, last_review] without building Word objects
+            """
             res = run_select(cls._table_name, {
-                'user_id': user_id,
-                'word': word.word,
-                'part_of_speech': word.part_of_speech
+                'user_id': user_id
             })
 
-            return bool(res)
+            return [((row[1], row[2]), row[3: 6], row[6]) for row in res]
+
+    # decks of active users, changes are written to the database and then to the deck
+    decks = DeckCache(Table.get_user_models)
 
     def __init__(self, user_id):
         self.user_id = user_id
 
+    @property
+    def deck(self) -> Deck:
+        return self.decks.get(self.user_id)
+
+    def has_word(self, word: Word) -> bool:
+        return (word.word, word.part_of_speech) in self.deck
+
     def add_new_word(self, word: Word) -> str:
         ebisu_tuple = ebisu.defaultModel(self.half_life)
-        self.Table.add_new_record(self.user_id, word, ebisu_tuple)
+
+        with self.deck.lock:
+            last_review = self.Table.add_new_record(self.user_id, word, ebisu_tuple)
+            self._set_record(word, ebisu_tuple, last_review)
+
+    def add_words(self, lines: typing.Iterable[str]) -> ImportReport:
+        """
+        adds words given as "word [part of speech]" lines
+
+        words which are already in the quiz are skipped, words which can't be found or looked up are reported
+        instead of aborting the whole import
+        """
+        report, keys = self.read_import(lines)
+        return self.add_imported(report, keys)
+
+    def read_import(self, lines: typing.Iterable[str]) -> tuple[ImportReport, dict[tuple[str, str], str]]:
+        """
+        returns the report of the lines which won't be added and the keys of the words to add with their lines
+        """
+        report = ImportReport([], [], [])
+        keys: dict[tuple[str, str], str] = {}
+        deck = self.deck
+
+        for line in lines:
+            if not line.strip():
+                continue
+
+            word, part_of_speech = parse_word_input(line)
+
+            try:
+                if part_of_speech is None:
+                    part_of_speech = Word._get_most_frequent_part_of_speech(word)
+            except WordNotFound as error:
+                report.failed.append((line, error))
+                continue
+
+            key = (word, part_of_speech)
+
+            if key in keys or key in deck:
+                report.already_in_quiz.append(line)
+            else:
+                keys[key] = line
+
+        return report, keys
+
+    def add_imported(self, report: ImportReport, keys: dict[tuple[str, str], str],
+                     declensions: dict[str, tuple] = None) -> ImportReport:
+        """
+        adds the words read by read_import to the quiz and the report, declensions are the ones already looked up
+        """
+        errors = {}
+        unstored = []
+        words = Word.get_many(keys, errors=errors, unstored=unstored, declensions=declensions)
+        report.failed.extend((keys[key], error) for key, error in errors.items())
+        ebisu_tuple = ebisu.defaultModel(self.half_life)
+        deck = self.deck
+
+        with deck.lock:
+            # the words may have been added while they were being looked up
+            for key in [key for key in words if key in deck]:
+                report.already_in_quiz.append(keys[key])
+                words.pop(key)
+
+            if words:
+                # definitions of the new words and the quiz records are written together
+                with transaction():
+                    Word.Table.add_words(unstored)
+                    last_review = self.Table.add_new_records(self.user_id, list(words.values()), ebisu_tuple)
+
+                for word in words.values():
+                    self._set_record(word, ebisu_tuple, last_review)
+
+        report.added.extend(words.values())
+        return report
+
+    @staticmethod
+    def _recall_weights(recall: np.ndarray) -> list[float]:
+        # the weight is squared to give more priority to words that are less likely to be recalled
+        return ((1 - recall) ** 2).tolist()
+
+    def _get_sampler(self) -> WeightedSampler:
+        """
+        returns the deck's sampler, weights of all words are recomputed once the time bucket changes
+
+        callers hold the deck's lock
+        """
+        now = time.time()
+        bucket = int(now // self.weight_refresh_interval)
+        deck = self.deck
+
+        if deck.sampler_bucket == bucket:
+            return deck.sampler
+
+        keys = list(deck.records)
+        models = [deck.records[key][0] for key in keys]
+        elapsed = [now - deck.records[key][1] for key in keys]
+        _, recall = predict_recall_models(models, elapsed)
+
+        deck.sampler.rebuild(keys, self._recall_weights(recall))
+        deck.sampler_bucket = bucket
+        return deck.sampler
+
+    def _set_record(self, word: Word, ebisu_tuple: tuple[float, float, float], last_review: float):
+        """
+        stores the just reviewed word in the deck, other words keep their weights until the next refresh
+
+        callers hold the deck's lock
+        """
+        key = (word.word, word.part_of_speech)
+        deck = self.deck
+        deck.set(key, ebisu_tuple, last_review)
+
+        # the prefetched draw only accounts for a change of the word it left out
+        if deck.prefetched is not None and deck.prefetched[1] != key:
+            deck.prefetched = None
+
+        if deck.sampler_bucket is not None:
+            _, recall = predict_recall_models([ebisu_tuple], [time.time() - last_review])
+            deck.sampler.add(key, self._recall_weights(recall)[0])
 
     def get_lowest_p_word(self) -> Word:
-        options = self.Table.get_all_user_words(self.user_id)
-        return sorted(options, key=lambda x: ebisu.predictRecall(x[1], x[2]))[0][0]
+        return self.Table.get_most_due_word(self.user_id)
 
     def get_word_to_recall(self) -> Word:
         """
         returns a word chosen randomly out of all words in the quiz
         probability of a word coming up is directly tied with the probability of a recall
         """
-        options = self.Table.get_all_user_words(self.user_id)
+        with self.deck.lock:
+            sampler = self._get_sampler()
+            key = self._take_prefetched()
 
-        population = [option[0] for option in options]
+            if key is None:
+                key = sampler.sample()
 
-        # the weight is squared to give more priority to words that are less likely to be recalled
-        weights = [(1 - ebisu.predictRecall(option[1], option[2], exact=1)) ** 2 for option in options]
+        return Word(*key)
 
-        return random.choices(population, weights=weights, k=1)[0]
+    def prefetch_word_to_recall(self, current: Word) -> Word:
+        """
+        draws the word to recall after the current one while the current one is being answered
+
+        the current word is left out of the draw, as its weight is about to change, and is put back
+        in by the next get_word_to_recall, the drawn word is built so that it's cached by then
+        """
+        key = (current.word, current.part_of_speech)
+        deck = self.deck
+
+        with deck.lock:
+            next_key = self._get_sampler().sample(exclude=key)
+            deck.prefetched = (next_key, key, deck.sampler_bucket)
+
+        return Word(*next_key)
+
+    def _take_prefetched(self) -> tuple[str, str] | None:
+        """
+        returns the prefetched draw fixed up with the current weight of the word it left out, if it's still valid
+
+        keeping the draw with probability of (total - weight) / total and taking the left out word otherwise
+        is the same as drawing from the whole deck
+
+        callers hold the deck's lock and have refreshed the sampler
+        """
+        deck = self.deck
+        prefetched, deck.prefetched = deck.prefetched, None
+
+        if prefetched is None:
+            return None
+
+        key, excluded, bucket = prefetched
+
+        # the weights were recomputed since the draw
+        if bucket != deck.sampler_bucket:
+            return None
+
+        if key != excluded and random.random() * deck.sampler.total < deck.sampler.get_weight(excluded):
+            return excluded
+
+        return key
 
     def update_word(self, word: Word, successes: float, total: float):
-        _, old_ebisu, time_elapsed = self.Table.get_word_info(self.user_id, word)
-        new_ebisu = ebisu.updateRecall(old_ebisu, successes, total, time_elapsed)
-        self.Table.update_word(self.user_id, word, new_ebisu)
+        deck = self.deck
+
+        # updates of the same user are serialized, so that none of them is based on an outdated record
+        with deck.lock:
+            record = deck.get((word.word, word.part_of_speech))
+
+            if record is None:
+                raise WordNotInQuiz(word.word, self.user_id)
+
+            old_ebisu, last_review = record
+            new_ebisu = ebisu.updateRecall(old_ebisu, successes, total, time.time() - last_review)
+            last_review = self.Table.update_word(self.user_id, word, new_ebisu)
+            self._set_record(word, new_ebisu, last_review)
 
 
 class CliQuiz(Quiz):
@@ -130,16 +342,7 @@ class CliQuiz(Quiz):
         while True:
             with CliBlock() as block:
                 try:
-                    word = block.input("add new word: ")
-
-                    part_of_speech = re.findall('\[[^]]+]', word)
-
-                    if part_of_speech:
-                        part_of_speech = part_of_speech[0][1:-1]
-                        word = re.sub(' \[[^]]+]', '', word)
-                    else:
-                        part_of_speech = None
-
+                    word, part_of_speech = parse_word_input(block.input("add new word: "))
                     word_obj = Word(word, part_of_speech)
                 except WordNotFound:
                     block.input('no such word, press enter button to continue..')
@@ -147,12 +350,24 @@ class CliQuiz(Quiz):
 
                 block.print(word_obj.__repr__(), *word_obj.en_definitions, sep='\n')
 
-                if self.Table.check_user_has_word(self.user_id, word_obj):
+                if self.has_word(word_obj):
                     block.print('word already in quiz')
                     block.input('press enter to continue...')
                 elif block.input('confirm adding this word Y/N: ').lower() == 'y':
                     self.add_new_word(word_obj)
 
+    def run_import(self, path: str):
+        """
+        adds words from a file with a "word [part of speech]" per line, - reads them from stdin
+        """
+        if path == '-':
+            report = self.add_words(sys.stdin.read().split('\n'))
+        else:
+            with open(path, 'r', encoding='utf-8') as file:
+                report = self.add_words(file.read().split('\n'))
+
+        print(report)
+
     def run_quiz(self):
         while True:
             with CliBlock() as word_block:
@@ -178,4 +393,14 @@ class CliQuiz(Quiz):
 
 
 if __name__ == '__main__':
-    CliQuiz(359230239).run_add_new_words()
+    parser = argparse.ArgumentParser(description='adds words to the quiz')
+    parser.add_argument('--import', dest='import_path',
+                        help='file with a "word [part of speech]" per line to add at once, - for stdin')
+    args = parser.parse_args()
+
+    quiz = CliQuiz(359230239)
+
+    if args.import_path is not None:
+        quiz.run_import(args.import_path)
+    else:
+        quiz.run_add_new_words()
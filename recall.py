@@ -0,0 +1,62 @@
+import numpy as np
+from scipy.special import betaln
+
+
+def predict_recall_batch(alpha, beta, t, elapsed) -> tuple[np.ndarray, np.ndarray]:
+    """
+    returns (log_recall, recall) arrays
+
+    arguments are array-likes of equal length, alpha beta and t come from the ebisu tuples,
+    elapsed is time elapsed from last recall in the same units as t
+
+    log_recall equals ebisu.predictRecall(prior, elapsed) and recall equals
+    ebisu.predictRecall(prior, elapsed, exact=True) for every word
+    """
+    alpha = np.asarray(alpha, dtype=np.float64)
+    beta = np.asarray(beta, dtype=np.float64)
+    t = np.asarray(t, dtype=np.float64)
+    elapsed = np.asarray(elapsed, dtype=np.float64)
+
+    log_recall = betaln(alpha + elapsed / t, beta) - betaln(alpha, beta)
+    return log_recall, np.exp(log_recall)
+
+
+def predict_recall_models(models: list[tuple[float, float, float]], elapsed) -> tuple[np.ndarray, np.ndarray]:
+    """
+    same as predict_recall_batch, but takes a list of ebisu tuples
+    """
+    if not models:
+        empty = np.empty(0, dtype=np.float64)
+        return empty, empty
+
+    alpha, beta, t = np.asarray(models, dtype=np.float64).T
+    return predict_recall_batch(alpha, beta, t, elapsed)
+
+
+if __name__ == '__main__':
+    # compares the batch prediction against ebisu on random models
+    import time
+
+    import ebisu
+
+    rng = np.random.default_rng(0)
+    size = 5000
+
+    alpha = rng.uniform(1.5, 20, size)
+    beta = rng.uniform(1.5, 20, size)
+    t = rng.uniform(60 * 60, 60 * 60 * 24 * 30, size)
+    elapsed = rng.uniform(0, 60 * 60 * 24 * 60, size)
+
+    start = time.perf_counter()
+    log_recall, recall = predict_recall_batch(alpha, beta, t, elapsed)
+    batch_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    expected_log = np.array([ebisu.predictRecall(model, e) for model, e in zip(zip(alpha, beta, t), elapsed)])
+    expected = np.array([ebisu.predictRecall(model, e, exact=True) for model, e in zip(zip(alpha, beta, t), elapsed)])
+    loop_time = time.perf_counter() - start
+
+    assert np.allclose(log_recall, expected_log, rtol=1e-9, atol=1e-12)
+    assert np.allclose(recall, expected, rtol=1e-9, atol=1e-12)
+
+    print(f'{size} words, batch - {batch_time * 1000:.2f} ms, ebisu loop - {loop_time * 1000:.2f} ms')
@@ -0,0 +1,144 @@
+import random
+import typing
+
+
+class WeightedSampler:
+    """
+    weighted random choice over keyed items backed by a fenwick (binary indexed) tree
+
+    draws, weight updates, additions and removals are O(log n), building from scratch is O(n)
+    """
+
+    def __init__(self, keys: typing.Iterable[typing.Hashable] = (), weights: typing.Iterable[float] = ()):
+        self._keys: list[typing.Hashable] = []
+        self._index: dict[typing.Hashable, int] = {}
+        self._weights: list[float] = []
+        # 1-based, _tree[i] stores the sum of weights in (i - lowbit(i), i]
+        self._tree: list[float] = [0.]
+        self.rebuild(keys, weights)
+
+    def rebuild(self, keys: typing.Iterable[typing.Hashable], weights: typing.Iterable[float]):
+        self._keys = list(keys)
+        self._weights = [float(weight) for weight in weights]
+
+        if len(self._keys) != len(self._weights):
+            raise ValueError(f'got {len(self._keys)} keys and {len(self._weights)} weights')
+
+        self._index = {key: i for i, key in enumerate(self._keys)}
+        self._tree = [0.] + self._weights
+
+        for i in range(1, len(self._tree)):
+            parent = i + (i & -i)
+
+            if parent < len(self._tree):
+                self._tree[parent] += self._tree[i]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key: typing.Hashable):
+        return key in self._index
+
+    def _prefix_sum(self, i: int) -> float:
+        """
+        sum of the first i weights
+        """
+        res = 0.
+
+        while i > 0:
+            res += self._tree[i]
+            i -= i & -i
+
+        return res
+
+    def _add_delta(self, position: int, delta: float):
+        i = position + 1
+
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    @property
+    def total(self) -> float:
+        return self._prefix_sum(len(self._keys))
+
+    def get_weight(self, key: typing.Hashable) -> float:
+        return self._weights[self._index[key]]
+
+    def update(self, key: typing.Hashable, weight: float):
+        position = self._index[key]
+        self._add_delta(position, weight - self._weights[position])
+        self._weights[position] = weight
+
+    def add(self, key: typing.Hashable, weight: float):
+        if key in self._index:
+            self.update(key, weight)
+            return
+
+        self._index[key] = len(self._keys)
+        self._keys.append(key)
+        self._weights.append(weight)
+
+        # the new node covers (i - lowbit(i), i], which apart from the new weight is already in the tree
+        i = len(self._tree)
+        self._tree.append(weight + self._prefix_sum(i - 1) - self._prefix_sum(i - (i & -i)))
+
+    def remove(self, key: typing.Hashable):
+        """
+        moves the last item into the removed item's place, so no gaps are left in the tree
+        """
+        position = self._index.pop(key)
+        last_key = self._keys.pop()
+        last_weight = self._weights.pop()
+        self._tree.pop()
+
+        if position == len(self._keys):
+            return
+
+        self._add_delta(position, last_weight - self._weights[position])
+        self._keys[position] = last_key
+        self._weights[position] = last_weight
+        self._index[last_key] = position
+
+    def sample(self, rng: random.Random = random, exclude: typing.Hashable = None) -> typing.Hashable:
+        """
+        returns a key with probability proportional to its weight
+
+        an excluded key is drawn as if its weight was zero, unless it's the only key
+        """
+        if not self._keys:
+            raise IndexError('sample from an empty sampler')
+
+        if exclude is None or exclude not in self._index or len(self._keys) == 1:
+            return self._sample(rng)
+
+        weight = self.get_weight(exclude)
+        self.update(exclude, 0.)
+
+        try:
+            return self._sample(rng, exclude)
+        finally:
+            self.update(exclude, weight)
+
+    def _sample(self, rng: random.Random, exclude: typing.Hashable = None) -> typing.Hashable:
+        total = self.total
+
+        if total <= 0:
+            return rng.choice(self._keys if exclude is None else [key for key in self._keys if key != exclude])
+
+        target = rng.random() * total
+        position = 0
+        step = 1 << (len(self._tree) - 1).bit_length()
+
+        # descend the tree looking for the first prefix sum greater than target
+        while step:
+            next_position = position + step
+
+            if next_position < len(self._tree) and self._tree[next_position] <= target:
+                position = next_position
+                target -= self._tree[next_position]
+
+            step >>= 1
+
+        # rounding may step past the last item with a non zero weight
+        return self._keys[min(position, len(self._keys) - 1)]
@@ -0,0 +1,283 @@
+import asyncio
+import collections
+import logging
+import time
+
+import aiogram
+from aiogram.utils import exceptions
+
+# telegram allows a bot about 30 messages a second overall and about a message a second per chat
+global_rate = 30
+chat_rate = 1
+# messages a chat may get at once after being idle
+chat_burst = 3
+# a deletion waits this long for a message to replace it with an edit, in seconds
+coalesce_window = 0.3
+# attempts after a flood control error
+max_retries = 3
+# latencies of this many last calls are kept for the stats
+latency_samples = 1000
+
+# send_message arguments which edit_message_text accepts as well
+_editable_kwargs = {'reply_markup', 'parse_mode', 'disable_web_page_preview'}
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    allows rate calls a second on average and up to capacity calls at once
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        while True:
+            self.refill()
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class SenderStats:
+    def __init__(self):
+        self.sent = 0
+        self.coalesced = 0
+        self.retries = 0
+        self.failed = 0
+        # calls queued and not started yet
+        self.queue_depth = 0
+        # seconds from queueing a call to its completion
+        self.latencies: collections.deque[float] = collections.deque(maxlen=latency_samples)
+
+    @property
+    def average_latency(self) -> float:
+        return sum(self.latencies) / len(self.latencies) if self.latencies else 0.
+
+    @property
+    def max_latency(self) -> float:
+        return max(self.latencies, default=0.)
+
+    def __repr__(self):
+        return f'sent - {self.sent}, coalesced - {self.coalesced}, retries - {self.retries}, ' \
+               f'failed - {self.failed}, queue depth - {self.queue_depth}, ' \
+               f'latency average - {self.average_latency * 1000:.0f} ms, max - {self.max_latency * 1000:.0f} ms'
+
+
+class _Call:
+    def __init__(self, method: str, args: tuple, kwargs: dict):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.queued_at = time.monotonic()
+
+
+def _log_failure(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning(f'failed to delete a message: {future.exception()}')
+
+
+class Sender:
+    """
+    queue of the bot's outgoing calls, limited by a global and a per chat token bucket
+
+    calls of a chat are made in the order they were queued, calls hitting flood control are retried
+    after the time telegram asks for, and a deletion followed by a message in the same chat is made
+    as a single edit of the deleted message
+    """
+
+    def __init__(self, bot: aiogram.Bot, rate: float = global_rate, per_chat_rate: float = chat_rate,
+                 per_chat_burst: float = chat_burst, window: float = coalesce_window):
+        self.bot = bot
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.window = window
+        self.stats = SenderStats()
+        self._global_bucket = TokenBucket(rate, rate)
+        self._chat_buckets: dict[int, TokenBucket] = {}
+        self._queues: dict[int, collections.deque[_Call]] = {}
+        self._workers: dict[int, asyncio.Task] = {}
+        # set when a call is queued for a chat whose worker waits to coalesce a deletion
+        self._arrivals: dict[int, asyncio.Event] = {}
+
+    async def send_message(self, chat_id: int, text: str, **kwargs) -> aiogram.types.Message:
+        return await self._enqueue(chat_id, 'send_message', (chat_id, text), kwargs)
+
+    async def edit_message_text(self, text: str, chat_id: int, message_id: int, **kwargs) -> aiogram.types.Message:
+        return await self._enqueue(chat_id, 'edit_message_text', (text, chat_id, message_id), kwargs)
+
+    async def delete_message(self, chat_id: int, message_id: int):
+        """
+        queues the deletion without waiting for it, so that a message sent right after can replace it by an edit
+        """
+        self._enqueue(chat_id, 'delete_message', (chat_id, message_id), {}).add_done_callback(_log_failure)
+
+    def _enqueue(self, chat_id: int, method: str, args: tuple, kwargs: dict) -> asyncio.Future:
+        call = _Call(method, args, kwargs)
+        self._queues.setdefault(chat_id, collections.deque()).append(call)
+        self.stats.queue_depth += 1
+
+        if chat_id in self._arrivals:
+            self._arrivals[chat_id].set()
+
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._work(chat_id))
+
+        return call.future
+
+    def _pop(self, chat_id: int) -> _Call:
+        self.stats.queue_depth -= 1
+        return self._queues[chat_id].popleft()
+
+    async def _work(self, chat_id: int):
+        queue = self._queues[chat_id]
+        # calls taken off the queue and not finished yet
+        taken: list[_Call] = []
+
+        try:
+            while queue:
+                call = self._pop(chat_id)
+                taken = [call]
+
+                if call.method == 'delete_message':
+                    next_call = await self._wait_for_next(chat_id)
+
+                    if next_call is not None and self._can_replace(next_call):
+                        self._pop(chat_id)
+                        taken.append(next_call)
+
+                        if not await self._coalesce(chat_id, call, next_call):
+                            await self._perform(chat_id, call)
+                            await self._perform(chat_id, next_call)
+
+                        continue
+
+                await self._perform(chat_id, call)
+        except BaseException as error:
+            # i.e. the worker is cancelled, callers waiting on the calls of the chat mustn't wait forever
+            while queue:
+                taken.append(self._pop(chat_id))
+
+            for call in taken:
+                self._abort(call, error)
+
+            raise
+        finally:
+            self._workers.pop(chat_id, None)
+
+            if not queue:
+                self._queues.pop(chat_id, None)
+
+            bucket = self._chat_buckets.get(chat_id)
+
+            if bucket is not None:
+                bucket.refill()
+
+                # a full bucket holds no state, it's recreated full on the next call
+                if bucket.tokens >= bucket.capacity:
+                    self._chat_buckets.pop(chat_id)
+
+    async def _wait_for_next(self, chat_id: int) -> _Call | None:
+        queue = self._queues[chat_id]
+
+        if not queue:
+            arrival = self._arrivals[chat_id] = asyncio.Event()
+
+            try:
+                await asyncio.wait_for(arrival.wait(), self.window)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self._arrivals.pop(chat_id, None)
+
+        return queue[0] if queue else None
+
+    @staticmethod
+    def _can_replace(call: _Call) -> bool:
+        reply_markup = call.kwargs.get('reply_markup')
+        # edited messages can only have inline keyboards
+        return call.method == 'send_message' and set(call.kwargs) <= _editable_kwargs and \
+            (reply_markup is None or isinstance(reply_markup, aiogram.types.InlineKeyboardMarkup))
+
+    async def _coalesce(self, chat_id: int, deletion: _Call, message: _Call) -> bool:
+        """
+        edits the message that was to be deleted into the new one, returns False if it can't be edited
+        """
+        _, message_id = deletion.args
+        _, text = message.args
+
+        try:
+            edited = await self._call(chat_id, 'edit_message_text', (text, chat_id, message_id), message.kwargs)
+        except Exception:
+            # i.e. the message is too old to be edited, the calls are made separately and fail separately if they do
+            return False
+
+        self.stats.coalesced += 1
+        self._finish(deletion, True)
+        self._finish(message, edited)
+        return True
+
+    async def _perform(self, chat_id: int, call: _Call):
+        try:
+            result = await self._call(chat_id, call.method, call.args, call.kwargs)
+        except Exception as error:
+            self.stats.failed += 1
+            self._abort(call, error)
+            return
+
+        self._finish(call, result)
+
+    async def _call(self, chat_id: int, method: str, args: tuple, kwargs: dict):
+        for attempt in range(max_retries + 1):
+            bucket = self._chat_buckets.setdefault(chat_id, TokenBucket(self.per_chat_rate, self.per_chat_burst))
+            await bucket.acquire()
+            await self._global_bucket.acquire()
+
+            try:
+                result = await getattr(self.bot, method)(*args, **kwargs)
+            except exceptions.RetryAfter as error:
+                if attempt == max_retries:
+                    raise
+
+                self.stats.retries += 1
+                await asyncio.sleep(error.timeout)
+                continue
+
+            self.stats.sent += 1
+            return result
+
+    def _finish(self, call: _Call, result):
+        self.stats.latencies.append(time.monotonic() - call.queued_at)
+
+        if not call.future.done():
+            call.future.set_result(result)
+
+    @staticmethod
+    def _abort(call: _Call, error: BaseException):
+        if call.future.done():
+            return
+
+        if isinstance(error, asyncio.CancelledError):
+            call.future.cancel()
+        else:
+            call.future.set_exception(error)
+
+    async def close(self):
+        """
+        waits until all the queued calls are made
+        """
+        while self._workers:
+            await asyncio.gather(*self._workers.values(), return_exceptions=True)
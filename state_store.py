@@ -0,0 +1,108 @@
+import time
+import typing
+from collections import OrderedDict
+
+from dbtools import run_select, run_upsert
+from storage import storage
+
+# states of this many recently active chats are kept in memory
+max_states = 1000
+# states of chats idle for longer are dropped from memory, they are restored from the database on the next update
+idle_ttl = 60 * 60  # an hour
+
+T = typing.TypeVar('T')
+
+
+class StateRecord(typing.NamedTuple):
+    # name of the state class
+    kind: str
+    word: str | None = None
+    part_of_speech: str | None = None
+    message_id: int | None = None
+
+
+class Table:
+    _table_name = 'telegram_states'
+
+    @classmethod
+    def get(cls, user_id: int) -> StateRecord | None:
+        res = run_select(cls._table_name, {
+            'user_id': user_id
+        })
+
+        if not res:
+            return None
+
+        _, kind, word, part_of_speech, message_id, _ = res[0]
+        return StateRecord(kind, word, part_of_speech, message_id)
+
+    @classmethod
+    def put(cls, user_id: int, record: StateRecord):
+        run_upsert(cls._table_name, ('user_id',), user_id, *record, time.time())
+
+
+class StateStore(typing.Generic[T]):
+    """
+    conversation states of the chats, LRU of live states of active chats over compact records in the database
+
+    every state set is written through to the database, so evicted states and states from before a restart
+    are restored from their records
+    """
+
+    def __init__(self, dump: typing.Callable[[T], StateRecord],
+                 restore: typing.Callable[[int, StateRecord], typing.Awaitable[T]],
+                 max_size: int = max_states, ttl: float = idle_ttl):
+        self.dump = dump
+        self.restore = restore
+        self.max_size = max_size
+        self.ttl = ttl
+        # user_id -> (state, time of the last access)
+        self._states: OrderedDict[int, tuple[T, float]] = OrderedDict()
+
+    def __len__(self):
+        return len(self._states)
+
+    async def get(self, user_id: int) -> T | None:
+        """
+        returns None for chats without a stored state
+        """
+        self._evict(time.monotonic())
+
+        if user_id in self._states:
+            state, _ = self._states.pop(user_id)
+            self._keep(user_id, state)
+            return state
+
+        record = await storage.run(Table.get, user_id)
+
+        if record is None:
+            return None
+
+        state = await self.restore(user_id, record)
+
+        # another update of the chat may have set the state in the meantime
+        if user_id in self._states:
+            return self._states[user_id][0]
+
+        self._keep(user_id, state)
+        return state
+
+    async def set(self, user_id: int, state: T):
+        self._states.pop(user_id, None)
+        self._keep(user_id, state)
+        await storage.run(Table.put, user_id, self.dump(state))
+
+    def _keep(self, user_id: int, state: T):
+        now = time.monotonic()
+        self._states[user_id] = (state, now)
+        self._evict(now)
+
+    def _evict(self, now: float):
+        # least recently used states are at the beginning
+        while self._states:
+            user_id, (_, last_access) = next(iter(self._states.items()))
+
+            if len(self._states) <= self.max_size and now - last_access <= self.ttl:
+                break
+
+            self._states.pop(user_id)
@@ -0,0 +1,131 @@
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import typing
+
+from quiz import ImportReport, Quiz
+from wiktionary import per_host_limit
+from word import Noun, Word, lookup_errors
+
+T = typing.TypeVar('T')
+
+logger = logging.getLogger(__name__)
+
+
+def _log_prefetch_failure(future: asyncio.Future):
+    # the word is drawn again when it's needed
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning(f'failed to prefetch a word to recall: {future.exception()}')
+
+
+class AsyncStorage:
+    """
+    awaitable access to the quiz and word tables for the bot's handlers
+
+    sqlite calls block, so they run on a small thread pool instead of the event loop, every thread has its own
+    connection, so a slow query of one user occupies one worker while the others keep serving other users
+    """
+
+    def __init__(self, workers: int = 4):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='storage')
+
+    async def run(self, func: typing.Callable[..., T], *args, **kwargs) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def get_word(self, word: str, part_of_speech: str = None, definitions: list[str] = None) -> Word:
+        if part_of_speech is None:
+            part_of_speech = await self.run(Word._get_most_frequent_part_of_speech, word)
+
+        cached = Word.cache.get((word, part_of_speech))
+
+        if cached is not None:
+            return cached
+
+        noun_info = None
+
+        # declensions are looked up asynchronously first and handed to the constructor,
+        # unless the constructor is going to fail on missing definitions anyway
+        if Word._get_type(part_of_speech) is Noun and \
+                (definitions is not None or await self.run(Word.has_definitions, word, part_of_speech)):
+            noun_info = await self.load_noun_info(word)
+
+        return await self.run(Word, word, part_of_speech, definitions, noun_info)
+
+    async def load_noun_info(self, word: str) -> tuple:
+        """
+        returns the declension, the stored one is fetched again once its wiktionary cache entry expires
+        """
+        stored = await self.run(Noun.get_stored_info, word)
+        noun_info = await Noun._get_noun_info_async(word, stored)
+
+        if noun_info != stored:
+            await self.run(Noun.Table.add_word, word, *noun_info)
+
+        return noun_info
+
+    async def load_nouns_info(self, words: typing.Iterable[str], concurrency: int = per_host_limit
+                              ) -> tuple[dict[str, tuple], dict[str, Exception]]:
+        """
+        looks declensions of many nouns up concurrently, returns the declensions and the errors of the nouns
+        which failed
+        """
+        words = list(words)
+        stored = await self.run(Noun.Table.get_words_info, words)
+        semaphore = asyncio.Semaphore(concurrency)
+        declensions = {}
+        errors = {}
+
+        async def load(word: str):
+            async with semaphore:
+                try:
+                    declensions[word] = await Noun._get_noun_info_async(word, stored.get(word))
+                except lookup_errors as error:
+                    errors[word] = error
+
+        await asyncio.gather(*(load(word) for word in words))
+        rows = [(word, *noun_info) for word, noun_info in declensions.items() if noun_info != stored.get(word)]
+
+        if rows:
+            await self.run(Noun.Table.add_words, rows)
+
+        return declensions, errors
+
+    async def has_word(self, quiz: Quiz, word: Word) -> bool:
+        return await self.run(quiz.has_word, word)
+
+    async def add_new_word(self, quiz: Quiz, word: Word):
+        await self.run(quiz.add_new_word, word)
+
+    async def add_words(self, quiz: Quiz, lines: typing.Iterable[str]) -> ImportReport:
+        """
+        missing declensions of the new nouns are fetched concurrently before the words are built
+        """
+        report, keys = await self.run(quiz.read_import, list(lines))
+        nouns = [word for word, part_of_speech in keys if part_of_speech == Noun.part_of_speech_tag]
+        declensions, errors = await self.load_nouns_info(await self.run(Noun.get_missing_info, nouns))
+
+        for key in [key for key in keys if key[1] == Noun.part_of_speech_tag and key[0] in errors]:
+            report.failed.append((keys.pop(key), errors[key[0]]))
+
+        return await self.run(quiz.add_imported, report, keys, declensions)
+
+    async def get_word_to_recall(self, quiz: Quiz) -> Word:
+        return await self.run(quiz.get_word_to_recall)
+
+    def prefetch_word_to_recall(self, quiz: Quiz, current: Word):
+        """
+        draws the next word to recall in the background, so that it's ready when the current word is answered
+        """
+        future = asyncio.get_running_loop().run_in_executor(self._executor, quiz.prefetch_word_to_recall, current)
+        future.add_done_callback(_log_prefetch_failure)
+
+    async def update_word(self, quiz: Quiz, word: Word, successes: float, total: float):
+        await self.run(quiz.update_word, word, successes, total)
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+
+storage = AsyncStorage()
@@ -0,0 +1,97 @@
+import asyncio
+import hmac
+import logging
+import secrets
+import typing
+
+import aiogram
+from aiohttp import web
+
+host = '127.0.0.1'
+port = 8080
+path = '/telegram/webhook'
+# telegram sends the secret token of the webhook in this header with every update
+secret_token_header = 'X-Telegram-Bot-Api-Secret-Token'
+
+logger = logging.getLogger(__name__)
+
+
+def create_app(dispatcher: aiogram.Dispatcher, webhook_path: str = path, public_url: str = None,
+               on_shutdown: typing.Callable[[aiogram.Dispatcher], typing.Awaitable] = None,
+               secret_token: str = None) -> web.Application:
+    """
+    receives telegram updates posted to webhook_path and feeds them to the dispatcher
+
+    updates are answered right away and handled in the background, so a burst of updates is handled concurrently,
+    on shutdown the server stops accepting updates and waits for the ones being handled
+
+    if public_url is given, the webhook is registered with telegram on startup,
+    without it updates can be posted locally, i.e. recorded update json with curl
+
+    if secret_token is given, requests without it in the secret token header are rejected,
+    a random one is generated when the webhook is registered, as anyone could post updates of whitelisted chats otherwise
+    """
+    if public_url is not None and secret_token is None:
+        secret_token = secrets.token_urlsafe(32)
+
+    in_flight: set[asyncio.Task] = set()
+
+    async def process_update(update: aiogram.types.Update):
+        # handlers and aiogram types look the bot up in the context, the executor sets it the same way
+        aiogram.Bot.set_current(dispatcher.bot)
+        aiogram.Dispatcher.set_current(dispatcher)
+
+        try:
+            await dispatcher.process_update(update)
+        except Exception:
+            logger.exception(f'failed to handle update {update.update_id}')
+
+    async def handle_update(request: web.Request) -> web.Response:
+        if secret_token is not None and \
+                not hmac.compare_digest(request.headers.get(secret_token_header, ''), secret_token):
+            raise web.HTTPForbidden()
+
+        try:
+            data = await request.json()
+        except ValueError:
+            raise web.HTTPBadRequest()
+
+        if not isinstance(data, dict):
+            raise web.HTTPBadRequest()
+
+        try:
+            update = aiogram.types.Update(**data)
+        except (TypeError, ValueError):
+            raise web.HTTPBadRequest()
+
+        task = asyncio.create_task(process_update(update))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+        return web.Response()
+
+    async def register_webhook(app: web.Application):
+        await dispatcher.bot.set_webhook(public_url.rstrip('/') + webhook_path, secret_token=secret_token)
+
+    async def drain(app: web.Application):
+        if in_flight:
+            await asyncio.wait(set(in_flight))
+
+        if on_shutdown is not None:
+            await on_shutdown(dispatcher)
+
+    app = web.Application()
+    app.router.add_post(webhook_path, handle_update)
+
+    if public_url is not None:
+        app.on_startup.append(register_webhook)
+
+    # sites are stopped before the shutdown signal, so no new updates arrive while draining
+    app.on_shutdown.append(drain)
+    return app
+
+
+def run(dispatcher: aiogram.Dispatcher, webhook_host: str = host, webhook_port: int = port,
+        webhook_path: str = path, public_url: str = None,
+        on_shutdown: typing.Callable[[aiogram.Dispatcher], typing.Awaitable] = None, secret_token: str = None):
+    web.run_app(create_app(dispatcher, webhook_path, public_url, on_shutdown, secret_token),
+                host=webhook_host, port=webhook_port)
@@ -0,0 +1,137 @@
+import json
+import threading
+import time
+import typing
+import zlib
+
+from dbtools import run_select, run_select_many, run_upsert, run_upsert_many
+
+positive_ttl = 60 * 60 * 24 * 30  # a month
+# pages of mistyped words may get created, so they are rechecked sooner
+negative_ttl = 60 * 60 * 24  # a day
+# keeping raw pages allows to reparse them without the network, at the cost of disk space
+store_html = False
+
+
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.expired = 0
+        self._lock = threading.Lock()
+
+    def count(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    @property
+    def requests_avoided(self) -> int:
+        return self.hits + self.negative_hits
+
+    def __repr__(self):
+        return f'hits - {self.hits}, negative hits - {self.negative_hits}, misses - {self.misses}, ' \
+               f'expired - {self.expired}'
+
+
+stats = CacheStats()
+
+
+class CacheEntry(typing.NamedTuple):
+    found: bool
+    declension: tuple | None
+    fetched_at: float
+
+
+class Table:
+    _table_name = 'wiki_cache'
+
+    @classmethod
+    def get(cls, word: str) -> CacheEntry | None:
+        res = run_select(cls._table_name, {
+            'word': word
+        })
+
+        if not res:
+            return None
+
+        return cls._get_entry(res[0])
+
+    @classmethod
+    def get_many(cls, words: typing.Iterable[str]) -> dict[str, CacheEntry]:
+        res = run_select_many(cls._table_name, ('word',), ((word,) for word in words))
+        return {row[0]: cls._get_entry(row) for row in res}
+
+    @staticmethod
+    def _get_entry(row: tuple) -> CacheEntry:
+        _, found, declension, _, fetched_at = row
+        return CacheEntry(bool(found), tuple(json.loads(declension)) if found else None, fetched_at)
+
+    @classmethod
+    def get_html(cls, word: str) -> str | None:
+        res = run_select(cls._table_name, {
+            'word': word
+        })
+
+        if not res or res[0][3] is None:
+            return None
+
+        return zlib.decompress(res[0][3]).decode('utf-8')
+
+    @classmethod
+    def _get_row(cls, word: str, declension: tuple | None, html: str | None, fetched_at: float) -> tuple:
+        compressed_html = zlib.compress(html.encode('utf-8')) if html is not None and store_html else None
+        declension_json = json.dumps(declension, ensure_ascii=False) if declension is not None else None
+        return word, int(declension is not None), declension_json, compressed_html, fetched_at
+
+    @classmethod
+    def put(cls, word: str, declension: tuple | None, html: str = None):
+        run_upsert(cls._table_name, ('word',), *cls._get_row(word, declension, html, time.time()))
+
+    @classmethod
+    def put_many(cls, entries: typing.Iterable[tuple[str, tuple | None]]):
+        """
+        entries are (word, declension or None if there is no page), pages are not stored
+        """
+        fetched_at = time.time()
+        run_upsert_many(cls._table_name, ('word',),
+                        (cls._get_row(word, declension, None, fetched_at) for word, declension in entries))
+
+
+def is_expired(entry: CacheEntry) -> bool:
+    ttl = positive_ttl if entry.found else negative_ttl
+    return time.time() - entry.fetched_at > ttl
+
+
+def lookup(word: str) -> CacheEntry | None:
+    """
+    returns a fresh cache entry, expired and missing entries count as a miss and return None
+
+    called once per declension needed, so that the counters tell how many requests the cache saved
+    """
+    entry = Table.get(word)
+
+    if entry is None:
+        stats.count('misses')
+        return None
+
+    if is_expired(entry):
+        stats.count('expired')
+        stats.count('misses')
+        return None
+
+    stats.count('hits' if entry.found else 'negative_hits')
+    return entry
+
+
+def lookup_many(words: typing.Iterable[str]) -> dict[str, CacheEntry]:
+    """
+    returns the fresh cache entries of the words, only they are counted,
+    words without a fresh entry are left to lookup, which counts them as misses
+    """
+    entries = {word: entry for word, entry in Table.get_many(words).items() if not is_expired(entry)}
+
+    for entry in entries.values():
+        stats.count('hits' if entry.found else 'negative_hits')
+
+    return entries
@@ -0,0 +1,102 @@
+import asyncio
+import os
+import urllib.parse
+
+import aiohttp
+
+# can point to a local mirror or to wiktionary_stub.py
+base_url = os.environ.get('WIKTIONARY_URL', 'https://de.wiktionary.org/wiki/')
+
+timeout = 10  # seconds, for a whole request
+retries = 3
+retry_delay = 0.5  # seconds, doubled after every attempt
+per_host_limit = 4
+
+# wikimedia blocks clients without a descriptive user agent, set WIKTIONARY_USER_AGENT to add contact information
+user_agent = os.environ.get('WIKTIONARY_USER_AGENT',
+                            'german_spaced_repetition/1.0 (telegram bot t.me/germanspacedrepetitionbot)')
+request_headers = {'User-Agent': user_agent}
+
+# 404 for missing pages, 400 for titles which can't be pages, other errors don't tell anything about the word
+not_found_statuses = {400, 404}
+# retried as well as 5xx responses
+retried_statuses = {408, 429}
+
+
+class PageNotFound(Exception):
+    pass
+
+
+class WiktionaryUnavailable(Exception):
+    pass
+
+
+def get_page_url(word: str, url: str = None) -> str:
+    return (url or base_url) + urllib.parse.quote(word)
+
+
+class WiktionaryClient:
+    """
+    fetches wiktionary pages over a shared keep-alive session
+
+    requests time out, failed ones (connection errors, 5xx and 429 responses) are retried with a growing delay,
+    and the number of simultaneous connections to a host is limited
+    """
+
+    def __init__(self, url: str = None, request_timeout: float = timeout, request_retries: int = retries,
+                 limit_per_host: int = per_host_limit):
+        self.url = url
+        self.timeout = request_timeout
+        self.retries = request_retries
+        self.limit_per_host = limit_per_host
+        self._session: aiohttp.ClientSession = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # created lazily, a session has to be created inside of a running loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit_per_host=self.limit_per_host)
+            self._session = aiohttp.ClientSession(connector=connector, headers=request_headers,
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+        return self._session
+
+    async def fetch_page(self, word: str) -> str:
+        """
+        returns html of the word's page, raises PageNotFound if there is no such page or the word isn't a valid title,
+        WiktionaryUnavailable if the page can't be fetched, i.e. wiktionary is down or refuses the client
+        """
+        url = get_page_url(word, self.url)
+        delay = retry_delay
+        last_error = None
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(delay)
+                delay *= 2
+
+            try:
+                async with self._get_session().get(url) as resp:
+                    if resp.status in retried_statuses or resp.status >= 500:
+                        last_error = WiktionaryUnavailable(f'{url} responded with {resp.status}')
+                        continue
+
+                    if resp.status in not_found_statuses:
+                        raise PageNotFound(word)
+
+                    # i.e. 403 for a blocked client, the word may well exist
+                    if resp.status >= 400:
+                        raise WiktionaryUnavailable(f'{url} responded with {resp.status}')
+
+                    return await resp.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                last_error = error
+
+        raise WiktionaryUnavailable(f'failed to fetch {url} after {self.retries + 1} attempts') from last_error
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+wiktionary_client = WiktionaryClient()
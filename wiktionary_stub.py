@@ -0,0 +1,37 @@
+import argparse
+import os
+
+from aiohttp import web
+
+
+def create_app(directory: str) -> web.Application:
+    """
+    serves saved wiktionary pages from a directory, i.e. for running the bot or the declension jobs offline
+
+    a page of a word is expected in <directory>/<word>.html, missing pages are answered with 404
+    """
+    async def handle_page(request: web.Request) -> web.Response:
+        word = request.match_info['word']
+        path = os.path.join(directory, f'{word}.html')
+
+        # the word comes from the url, it must not escape the directory
+        if os.path.dirname(os.path.abspath(path)) != os.path.abspath(directory) or not os.path.isfile(path):
+            raise web.HTTPNotFound()
+
+        with open(path, 'r', encoding='utf-8') as file:
+            return web.Response(text=file.read(), content_type='text/html')
+
+    app = web.Application()
+    app.router.add_get('/wiki/{word}', handle_page)
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='serves saved wiktionary pages')
+    parser.add_argument('directory')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    args = parser.parse_args()
+
+    print(f'set WIKTIONARY_URL=http://{args.host}:{args.port}/wiki/ to use the stub')
+    web.run_app(create_app(args.directory), host=args.host, port=args.port)
@@ -1,14 +1,23 @@
 from __future__ import annotations
 
+import asyncio
 import itertools
-import json
 import random
+import re
+import threading
+import typing
+from collections import OrderedDict
 
 import requests
 
 from bs4 import BeautifulSoup as Soup
-from dbtools import run_insert
-from dbtools import run_select
+from dbtools import run_delete, run_delete_many, run_insert_many, run_upsert, run_upsert_many, transaction
+from dbtools import run_select, run_select_many
+import wiki_cache
+from declension_parser import DeclensionParseError, declension_table_class, parse_declension_rows
+from dictionary_format import ShardedDictionary
+from wiktionary import PageNotFound, WiktionaryClient, WiktionaryUnavailable, get_page_url, not_found_statuses, \
+    request_headers, timeout, wiktionary_client
 
 
 class WordNotFound(Exception):
@@ -21,19 +30,136 @@ class DefinitionNotFound(WordNotFound):
     pass
 
 
-path_to_dictionary = 'data/parsed_dictionary.json'
+# errors of looking up a single word, batches of words collect them per word
+lookup_errors = (WordNotFound, DeclensionParseError, requests.RequestException, WiktionaryUnavailable)
+
+path_to_dictionary = 'data/parsed_dictionary'
+
+part_of_speech_annotation = re.compile(r'\[[^]]+]')
+spaced_part_of_speech_annotation = re.compile(r' ?\[[^]]+]')
+
+
+def parse_word_input(line: str) -> tuple[str, str | None]:
+    """
+    parses user input of the form "word [part of speech]", part of speech is optional and None if not given
+    """
+    part_of_speech = part_of_speech_annotation.findall(line)
+
+    if not part_of_speech:
+        return line.strip(), None
+
+    return spaced_part_of_speech_annotation.sub('', line).strip(), part_of_speech[0][1:-1]
+
+
+_dictionary: ShardedDictionary = None
+_dictionary_lock = threading.Lock()
+
+
+def get_dictionary() -> ShardedDictionary:
+    """
+    opens the dictionary on first use, so that importing this module doesn't touch it
+    """
+    global _dictionary
+
+    if _dictionary is None:
+        with _dictionary_lock:
+            if _dictionary is None:
+                _dictionary = ShardedDictionary(path_to_dictionary)
+
+    return _dictionary
+
+
+def prewarm_dictionary(background: bool = True) -> threading.Thread | None:
+    """
+    opens the dictionary and pages it into memory, so that the first lookup doesn't pay for it
+    """
+    if not background:
+        get_dictionary().prewarm()
+        return None
+
+    thread = threading.Thread(target=prewarm_dictionary, args=(False,), name='dictionary-prewarm', daemon=True)
+    thread.start()
+    return thread
+
+
+class WordCache:
+    """
+    LRU of built words, words are immutable, so the same object is handed out to every user learning the word
+    """
+
+    def __init__(self, max_words: int = 20000):
+        self.max_words = max_words
+        self._words: OrderedDict[tuple[str, str], Word] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._words)
+
+    def get(self, key: tuple[str, str]) -> Word | None:
+        with self._lock:
+            word = self._words.get(key)
+
+            if word is not None:
+                self._words.move_to_end(key)
+
+            return word
+
+    def add(self, key: tuple[str, str], word: Word) -> Word:
+        """
+        returns the word stored under the key, which is not the given one if another thread built it first
+        """
+        with self._lock:
+            if key in self._words:
+                self._words.move_to_end(key)
+                return self._words[key]
+
+            self._words[key] = word
+
+            while len(self._words) > self.max_words:
+                self._words.popitem(last=False)
+
+            return word
+
+    def invalidate(self, word: str, part_of_speech: str = None):
+        """
+        drops the word with the given part of speech, or with any part of speech if it's None
+        """
+        with self._lock:
+            if part_of_speech is not None:
+                self._words.pop((word, part_of_speech), None)
+                return
+
+            for key in [key for key in self._words if key[0] == word]:
+                self._words.pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._words.clear()
 
 
 class Word:
+    """
+    words are interned: Word(...) returns the shared instance for the (word, part_of_speech) if it was built before
+    """
+    __slots__ = ('word', 'part_of_speech', 'en_definitions')
+
+    # part of speech of words of the subclass, the most frequent one is looked up for Word
+    part_of_speech_tag: str = None
+
+    cache = WordCache()
+
     class Table:
         _table_name = 'words'
 
         @classmethod
         def get_word_info(cls, word: str, part_of_speech: str) -> None | tuple[str, str, list[str]]:
+            """
+            definitions are read with one lookup of the words_word index, in the order they were stored in
+            """
             res = run_select(cls._table_name, {
                 'word': word,
                 'part_of_speech': part_of_speech
-            })
+            }, ordered=True)
 
             if not res:
                 return None
@@ -45,36 +171,185 @@ class Word:
 
             return word, part_of_speech, en_definitions
 
+        @classmethod
+        def get_words_info(cls, keys: typing.Iterable[tuple[str, str]]) -> dict[tuple[str, str], list[str]]:
+            """
+            returns definitions of many words at once, keys are (word, part_of_speech)
+
+            words without stored definitions are missing from the result
+            """
+            res = run_select_many(cls._table_name, ('word', 'part_of_speech'), keys, ordered=True)
+            en_definitions = {}
+
+            for word, part_of_speech, definition in res:
+                en_definitions.setdefault((word, part_of_speech), []).append(definition)
+
+            return en_definitions
+
         @classmethod
         def add_word(cls, word: str, part_of_speech: str, en_definitions: list[str]):
-            for definition in en_definitions:
-                run_insert(cls._table_name, word, part_of_speech, definition)
+            """
+            replaces the word's definitions as a whole in one transaction, so that concurrent additions of
+            the same word don't store its definitions twice
+            """
+            with transaction():
+                run_delete(cls._table_name, {
+                    'word': word,
+                    'part_of_speech': part_of_speech
+                })
+                run_insert_many(cls._table_name,
+                                ((word, part_of_speech, definition) for definition in en_definitions))
+
+            Word.invalidate(word, part_of_speech)
 
-    with open(path_to_dictionary, 'r', encoding='utf-8') as file:
-        de_en_dictionary = json.load(file)
+        @classmethod
+        def add_words(cls, words: typing.Iterable[Word]):
+            """
+            stores definitions of words built by get_many without storing them, replacing stored ones as add_word does
+
+            the words are already built from these definitions, so they stay cached
+            """
+            words = list(words)
+
+            with transaction():
+                run_delete_many(cls._table_name, ('word', 'part_of_speech'),
+                                ((word.word, word.part_of_speech) for word in words))
+                run_insert_many(cls._table_name, ((word.word, word.part_of_speech, definition)
+                                                  for word in words for definition in word.en_definitions))
 
     def __repr__(self):
         return f'{self.word} [{self.part_of_speech}]'
 
-    def __new__(cls, word: str, part_of_speech: str = None, definitions: list[str] = None):
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable, it is shared between users')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'{type(self).__name__} is immutable, it is shared between users')
+
+    def _set(self, **attributes):
+        for name, value in attributes.items():
+            object.__setattr__(self, name, value)
+
+    @staticmethod
+    def _get_type(part_of_speech: str) -> type[Word]:
         return_types = {
             'noun': Noun
         }
 
+        return return_types.get(part_of_speech, Word)
+
+    def __new__(cls, word: str, part_of_speech: str = None, definitions: list[str] = None, noun_info: tuple = None):
+        """
+        noun_info is a declension the caller has already looked up, i.e. without blocking the loop
+        """
         if part_of_speech is None:
-            part_of_speech = cls._get_most_frequent_part_of_speech(word)
+            part_of_speech = cls.part_of_speech_tag or cls._get_most_frequent_part_of_speech(word)
+
+        key = (word, part_of_speech)
+        instance = Word.cache.get(key)
 
-        if part_of_speech in return_types:
-            instance = object.__new__(return_types[part_of_speech])
-        else:
-            instance = object.__new__(Word)
+        if instance is None:
+            instance = object.__new__(cls._get_type(part_of_speech))
+            instance._load(word, part_of_speech, definitions, noun_info)
+            instance = Word.cache.add(key, instance)
 
         return instance
 
-    def __init__(self, word: str, part_of_speech: str = None, definitions: list[str] = None):
-        if part_of_speech is None:
-            part_of_speech = self._get_most_frequent_part_of_speech(word)
+    @classmethod
+    def invalidate(cls, word: str, part_of_speech: str = None):
+        """
+        has to be called when stored information about the word changes, the next Word(...) builds it anew
+        """
+        Word.cache.invalidate(word, part_of_speech)
+
+    def _set_info(self, word: str, part_of_speech: str, en_definitions: typing.Iterable[str],
+                  noun_info: tuple = None):
+        self._set(word=word, part_of_speech=part_of_speech, en_definitions=tuple(en_definitions))
+
+    @classmethod
+    def get_many(cls, keys: typing.Iterable[tuple[str, str]], errors: dict[tuple[str, str], Exception] = None,
+                 unstored: list[Word] = None, declensions: dict[str, tuple] = None) -> dict[tuple[str, str], Word]:
+        """
+        builds words for many (word, part_of_speech) keys at once
+
+        words which are not in the cache are loaded with one batched query for definitions and one for
+        declensions instead of queries per word, words which are not stored yet are built the usual way
+
+        if errors is given, words which can't be found or looked up are put there instead of raising
+
+        if unstored is given, definitions of words which are not stored yet are not written one word at a time,
+        the words are put there instead, to be stored at once with Word.Table.add_words
+
+        declensions are the ones the caller has already looked up, stored declensions of other nouns are used
+        while their wiktionary cache entries are fresh and looked up again once they expire
+        """
+        words = {}
+        missing = []
+
+        for key in dict.fromkeys(keys):
+            word = Word.cache.get(key)
+
+            if word is None:
+                missing.append(key)
+            else:
+                words[key] = word
+
+        if not missing:
+            return words
+
+        declensions = declensions or {}
+        en_definitions = Word.Table.get_words_info(missing)
+        stored_declensions = Noun.Table.get_words_info(key[0] for key in missing if cls._get_type(key[1]) is Noun)
+        fresh = wiki_cache.lookup_many(word for word in stored_declensions if word not in declensions)
+
+        for key in missing:
+            word, part_of_speech = key
+            word_type = cls._get_type(part_of_speech)
+            stored = stored_declensions.get(word)
+            noun_info = declensions.get(word, stored if word in fresh else None)
+
+            if key not in en_definitions or (word_type is Noun and noun_info is None):
+                try:
+                    if unstored is not None and key not in en_definitions:
+                        instance = cls._build_unstored(word, part_of_speech, noun_info, stored)
+                        words[key] = Word.cache.add(key, instance)
+                        unstored.append(words[key])
+                    else:
+                        words[key] = Word(word, part_of_speech)
+                except lookup_errors as error:
+                    if errors is None:
+                        raise
 
+                    errors[key] = error
+
+                continue
+
+            instance = object.__new__(word_type)
+            instance._set_info(word, part_of_speech, en_definitions[key], noun_info)
+            words[key] = Word.cache.add(key, instance)
+
+        return words
+
+    @classmethod
+    def _build_unstored(cls, word: str, part_of_speech: str, noun_info: tuple = None, stored: tuple = None) -> Word:
+        """
+        builds the word out of the dictionary without storing its definitions, the declension is looked up
+        and stored as usual
+        """
+        word_type = cls._get_type(part_of_speech)
+        _, _, en_definitions = cls._get_word_info(word, part_of_speech)
+
+        if word_type is Noun and noun_info is None:
+            noun_info = Noun._refresh_noun_info(word, stored)
+
+        instance = object.__new__(word_type)
+        instance._set_info(word, part_of_speech, en_definitions, noun_info)
+        return instance
+
+    def _load(self, word: str, part_of_speech: str, definitions: list[str] = None, noun_info: tuple = None):
+        """
+        sets the stored information, the missing information is looked up and stored
+        """
         word_info = Word.Table.get_word_info(word, part_of_speech)
 
         if word_info is None:
@@ -85,33 +360,55 @@ class Word:
 
             Word.Table.add_word(*word_info)
 
-        self.word = word
-        self.part_of_speech = part_of_speech
-        self.en_definitions = word_info[-1]
+        Word._set_info(self, word, part_of_speech, word_info[-1])
+
+    @classmethod
+    def has_definitions(cls, word: str, part_of_speech: str) -> bool:
+        """
+        whether the word can be constructed without providing the definitions
+        """
+        return Word.Table.get_word_info(word, part_of_speech) is not None or \
+            get_dictionary().get_definitions(word, part_of_speech) is not None
 
     @staticmethod
-    def load_wiki_page(word: str) -> Soup:
-        url = f'https://de.wiktionary.org/wiki/{word}'
-        resp = requests.get(url)
+    def load_wiki_html(word: str) -> str:
+        url = get_page_url(word)
+        resp = requests.get(url, timeout=timeout, headers=request_headers)
 
-        if resp.status_code == 404:
+        if resp.status_code in not_found_statuses:
             raise WordNotFound
 
-        return Soup(resp.text, features="html.parser")
+        if resp.status_code >= 400:
+            raise WiktionaryUnavailable(f'{url} responded with {resp.status_code}')
+
+        return resp.text
+
+    @classmethod
+    def load_wiki_page(cls, word: str) -> Soup:
+        return Soup(cls.load_wiki_html(word), features="html.parser")
+
+    @staticmethod
+    async def load_wiki_html_async(word: str, client: WiktionaryClient = wiktionary_client) -> str:
+        try:
+            return await client.fetch_page(word)
+        except PageNotFound:
+            raise WordNotFound
 
     @classmethod
     def _get_most_frequent_part_of_speech(cls, word: str):
-        if word not in cls.de_en_dictionary:
+        part_of_speech = get_dictionary().get_most_frequent_part_of_speech(word)
+
+        if part_of_speech is None:
             raise DefinitionNotFound
 
-        return sorted(list(cls.de_en_dictionary[word].items()), key=lambda x: len(list(x)[1]))[-1][0]
+        return part_of_speech
 
     @classmethod
     def _get_word_info(cls, word, part_of_speech):
-        if word not in cls.de_en_dictionary or part_of_speech not in cls.de_en_dictionary[word]:
-            raise DefinitionNotFound
+        en_definitions = get_dictionary().get_definitions(word, part_of_speech)
 
-        en_definitions = cls.de_en_dictionary[word][part_of_speech]
+        if en_definitions is None:
+            raise DefinitionNotFound
 
         return word, part_of_speech, en_definitions
 
@@ -179,7 +476,9 @@ class Noun(Word):
     args order:
     nom_s, nom_p, gen_s, gen_p, dat_s, dat_p, acc_s, acc_p, article
     """
-    part_of_speech = 'noun'
+    __slots__ = ('nom_s', 'nom_p', 'gen_s', 'gen_p', 'dat_s', 'dat_p', 'acc_s', 'acc_p', 'article')
+
+    part_of_speech_tag = 'noun'
 
     class Table:
         _table_name = 'nouns'
@@ -195,31 +494,190 @@ class Noun(Word):
 
             return res[0]
 
+        @classmethod
+        def get_words_info(cls, words: typing.Iterable[str]) -> dict[str, tuple]:
+            """
+            returns declensions of many nouns at once, nouns without stored declensions are missing from the result
+            """
+            res = run_select_many(cls._table_name, ('word',), ((word,) for word in words))
+
+            # first column is the word itself
+            return {row[0]: row[1:] for row in res}
+
         @classmethod
         def add_word(cls, word, *args):
-            run_insert(cls._table_name, word, *args)
+            run_upsert(cls._table_name, ('word',), word, *args)
+            Word.invalidate(word, Noun.part_of_speech_tag)
 
-    def __init__(self, word, *args, definitions: list[str] = None, **kwargs):
-        super().__init__(word, self.part_of_speech, definitions=definitions)
+        @classmethod
+        def add_words(cls, rows: typing.Iterable[tuple]):
+            """
+            rows are (word, *noun_info)
+            """
+            rows = list(rows)
+            run_upsert_many(cls._table_name, ('word',), rows)
 
-        noun_info = self.Table.get_word_info(word)
+            for row in rows:
+                Word.invalidate(row[0], Noun.part_of_speech_tag)
 
-        if noun_info is not None:
-            # first column is the word itself
-            noun_info = noun_info[1:]
-        else:
-            noun_info = self._get_noun_info(word)
-            self.Table.add_word(word, *noun_info)
+    @classmethod
+    def get_missing_info(cls, words: typing.Iterable[str]) -> list[str]:
+        """
+        returns the nouns which have definitions, but no stored declension or one whose cache entry has expired
+        """
+        words = list(words)
+        entries = wiki_cache.Table.get_many(words)
+        return [word for word in words
+                if (word not in entries or wiki_cache.is_expired(entries[word])) and
+                Word.has_definitions(word, cls.part_of_speech_tag)]
+
+    @classmethod
+    def get_stored_info(cls, word: str) -> tuple | None:
+        noun_info = cls.Table.get_word_info(word)
+
+        # first column is the word itself
+        return noun_info[1:] if noun_info is not None else None
+
+    def _load(self, word: str, part_of_speech: str, definitions: list[str] = None, noun_info: tuple = None):
+        super()._load(word, part_of_speech, definitions)
 
-        self.nom_s, self.nom_p, self.gen_s, self.gen_p, self.dat_s, self.dat_p, self.acc_s, self.acc_p, self.article = \
-            noun_info
+        if noun_info is None:
+            noun_info = self._refresh_noun_info(word, self.get_stored_info(word))
+
+        self._set_noun_info(noun_info)
+
+    def _set_info(self, word: str, part_of_speech: str, en_definitions: list[str], noun_info: tuple = None):
+        super()._set_info(word, part_of_speech, en_definitions)
+        self._set_noun_info(noun_info)
+
+    def _set_noun_info(self, noun_info: tuple):
+        self._set(**dict(zip(Noun.__slots__, noun_info, strict=True)))
 
     @classmethod
-    def _get_noun_info(cls, word) -> tuple:
-        declension_table = cls.load_wiki_page(word).find('table', {
-            'class': 'wikitable float-right inflection-table flexbox hintergrundfarbe2'})
-        cases: list[list[Soup]] = [row.findAll('td') for row in declension_table.findAll('tr')[1:]]
-        cases_pairs_list = tuple(itertools.chain([cases[i][0].text, cases[i][1].text] for i in range(4)))
+    def _refresh_noun_info(cls, word: str, stored: tuple = None) -> tuple:
+        """
+        looks the declension up and stores it if it differs from the stored one
+        """
+        noun_info = cls._get_noun_info(word, stored)
+
+        if noun_info != stored:
+            cls.Table.add_word(word, *noun_info)
+
+        return noun_info
+
+    @staticmethod
+    def _get_entry_info(entry: wiki_cache.CacheEntry, stored: tuple = None) -> tuple:
+        if entry.found:
+            return entry.declension
+
+        # the page is gone, but the noun may already be in quizzes
+        if stored is None:
+            raise WordNotFound
+
+        return stored
+
+    @classmethod
+    def _get_noun_info(cls, word, stored: tuple = None) -> tuple:
+        """
+        looks the declension up in the wiktionary cache first, pages that were not found are cached as well
+
+        the stored declension is fetched again once its cache entry expires, it's kept if the page can't be
+        fetched or parsed anymore
+        """
+        entry = wiki_cache.lookup(word)
+
+        if entry is not None:
+            return cls._get_entry_info(entry, stored)
+
+        try:
+            html = cls.load_wiki_html(word)
+            noun_info = cls._parse_noun_page(html)
+        except WordNotFound:
+            wiki_cache.Table.put(word, None)
+            return cls._get_entry_info(wiki_cache.CacheEntry(False, None, 0), stored)
+        except DeclensionParseError:
+            if stored is None:
+                raise
+
+            # the page changed its layout, the stored declension counts as revalidated
+            wiki_cache.Table.put(word, stored)
+            return stored
+        except (WiktionaryUnavailable, requests.RequestException):
+            if stored is None:
+                raise
+
+            # fetched again next time
+            return stored
+
+        wiki_cache.Table.put(word, noun_info, html)
+        return noun_info
+
+    @classmethod
+    async def _get_noun_info_async(cls, word, stored: tuple = None,
+                                   client: WiktionaryClient = wiktionary_client) -> tuple:
+        """
+        same as _get_noun_info, but the page is fetched without blocking the loop,
+        the cache is accessed and the page is parsed in the default executor
+        """
+        loop = asyncio.get_running_loop()
+        entry = await loop.run_in_executor(None, wiki_cache.lookup, word)
+
+        if entry is not None:
+            return cls._get_entry_info(entry, stored)
+
+        try:
+            html = await cls.load_wiki_html_async(word, client)
+            noun_info = await loop.run_in_executor(None, cls._parse_noun_page, html)
+        except WordNotFound:
+            await loop.run_in_executor(None, wiki_cache.Table.put, word, None)
+            return cls._get_entry_info(wiki_cache.CacheEntry(False, None, 0), stored)
+        except DeclensionParseError:
+            if stored is None:
+                raise
+
+            await loop.run_in_executor(None, wiki_cache.Table.put, word, stored)
+            return stored
+        except WiktionaryUnavailable:
+            if stored is None:
+                raise
+
+            return stored
+
+        await loop.run_in_executor(None, wiki_cache.Table.put, word, noun_info, html)
+        return noun_info
+
+    @classmethod
+    def _parse_noun_page(cls, html: str) -> tuple:
+        """
+        parses only the declension table out of the page, falls back to parsing the whole page with BeautifulSoup
+        """
+        try:
+            return cls._build_noun_info(parse_declension_rows(html)[1:])
+        except DeclensionParseError:
+            return cls._parse_noun_info(Soup(html, features="html.parser"))
+
+    @classmethod
+    def _parse_noun_info(cls, page: Soup) -> tuple:
+        """
+        raises DeclensionParseError if the page has no declension table of the expected shape
+        """
+        declension_table = page.find('table', {'class': declension_table_class})
+
+        if declension_table is None:
+            raise DeclensionParseError('the page has no declension table')
+
+        cases = [[cell.text for cell in row.findAll('td')] for row in declension_table.findAll('tr')[1:]]
+        return cls._build_noun_info(cases)
+
+    @classmethod
+    def _build_noun_info(cls, cases: list[list[str]]) -> tuple:
+        """
+        cases are texts of the td cells of the declension table rows, without the header row
+        """
+        if len(cases) < 4 or any(len(row) < 2 for row in cases[:4]) or not cases[0][0].split():
+            raise DeclensionParseError('the declension table has an unexpected shape')
+
+        cases_pairs_list = tuple(itertools.chain([cases[i][0], cases[i][1]] for i in range(4)))
         cases_tuple = []
 
         for pair in cases_pairs_list: